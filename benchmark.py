@@ -0,0 +1,677 @@
+import os
+import copy
+import io
+import json
+import time
+import argparse
+import tempfile
+import random
+import socket
+import smtplib
+import threading
+import subprocess
+import tracemalloc
+import multiprocessing
+
+try:
+    import resource ### peak RSS, not available on Windows
+except ImportError:
+    resource = None
+
+from time import perf_counter
+from types import SimpleNamespace
+from datetime import datetime
+from contextlib import contextmanager, redirect_stdout
+from email.mime.text import MIMEText
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import main
+from synthetic import generate_workbook, generate_sheets, random_names
+
+
+
+scales = {
+    "small"  : {"n_IPOs" : 100,  "allotments_per_IPO" : 200},
+    "medium" : {"n_IPOs" : 500,  "allotments_per_IPO" : 1000},
+    "large"  : {"n_IPOs" : 2000, "allotments_per_IPO" : 500},
+    "1m"     : {"n_IPOs" : 1000, "allotments_per_IPO" : 1000}, ### about 0.9M subscription rows, for memory; a sheet holds 1048576
+}
+
+renderers = main.html_renderers
+
+### excel_writer constant_memory: auto is the daily run's switch at 100k subscription rows
+writer_modes = {
+    "auto"     : None,
+    "default"  : False,
+    "constant" : True,
+}
+
+
+
+def version():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output = True, text = True, cwd = os.path.dirname(os.path.abspath(__file__))).stdout.strip() or "unknown"
+    except OSError:
+        return "unknown"
+
+def run_pipeline(file_path, today, renderer, profiler, output_path, constant_memory = None):
+    ### IPO_calendar -> excel_writer -> HTML, the same stages as the daily run
+    with profiler.stage("load sheets"):
+        IPO_raw, subscription_raw, workday_sheet = main.load_workbook(file_path)
+    with profiler.stage("build IPO_calendar"):
+        context = main.run_context(today, IPO_raw, subscription_raw, workday_sheet, {}, main.pinyin_cache())
+        data = main.IPO_calendar(context)
+
+    if constant_memory is None:
+        constant_memory = len(subscription_raw.index) > 100000
+    reset_peak_rss() ### so that writer_peak_rss is the workbook's own, not the sheet loading's
+    writer_base = proc_status("VmRSS")
+    writer = main.excel_writer(output_path, context, constant_memory = constant_memory, html = renderer())
+    with profiler.stage("generate_IPO_calendar", exclude = writer.html):
+        html_tables = writer.generate_IPO_calendar(data)
+    with profiler.stage("today_offering", exclude = writer.html):
+        html_tables += writer.today_offering(data)
+    with profiler.stage("today_purchase", exclude = writer.html):
+        html_tables += writer.today_purchase(data)
+    with profiler.stage("tomorrow_purchase", exclude = writer.html):
+        html_tables += writer.tomorrow_purchase(data)
+    with profiler.stage("save workbook"):
+        writer.save()
+    writer_peak = proc_status("VmHWM")
+    if writer_peak is not None and writer_base is not None:
+        writer_peak -= writer_base
+    profiler.record("to_html", writer.html.wall, writer.html.cpu)
+    with profiler.stage("html document"):
+        mainbody = writer.html.document(html_tables)
+    return len(mainbody.encode('utf-8')), writer_peak
+
+def peak_rss():
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 ### KiB on Linux
+
+def reset_peak_rss():
+    ### Linux only, VmHWM restarts from the current RSS
+    try:
+        with open("/proc/self/clear_refs", 'w') as f:
+            f.write("5")
+    except OSError:
+        pass
+
+def proc_status(field):
+    ### VmRSS, or VmHWM (peak RSS since the last reset_peak_rss()), in bytes; None where /proc is not available
+    try:
+        with open("/proc/self/status", 'r') as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def load_results(results_path):
+    results = []
+    if os.path.exists(results_path):
+        with open(results_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    results.append(json.loads(line))
+    return results
+
+def run_isolated(function, *args):
+    ### in a fresh process, so that peak_rss() belongs to this run alone and not to the scales run before it
+    with ProcessPoolExecutor(max_workers = 1, mp_context = multiprocessing.get_context("spawn")) as pool:
+        return pool.submit(function, *args).result()
+
+def run_scale(file_path, today, renderer_name, output_path, trace_memory, writer_mode = "auto"):
+    profiler = main.run_profiler(trace_memory = trace_memory)
+    body_size, writer_peak = run_pipeline(file_path, today, renderers[renderer_name], profiler, output_path, writer_modes[writer_mode])
+    return {
+        "wall"            : sum(stage["wall"] for stage in profiler.stages),
+        "body_size"       : body_size,
+        "peak_rss"        : peak_rss(),
+        "writer_peak_rss" : writer_peak, ### peak growth from excel_writer creation to save(), what constant_memory changes
+        "stages"    : profiler.stages,
+    }
+
+def benchmark(scale_names, renderer_names, results_path, workdir, trace_memory = False, mode_names = ("auto",)):
+    os.makedirs(workdir, exist_ok = True)
+    previous = load_results(results_path)
+    current_version = version()
+
+    for name in scale_names:
+        params = scales[name]
+        file_path = os.path.join(workdir, "wind_" + "_".join(f"{key}{value}" for key, value in params.items()) + ".xlsx")
+        workdays = generate_workbook(file_path, **params)
+        today = datetime.strptime(str(workdays[len(workdays) // 2]), "%Y%m%d") ### mid-calendar, every bucket has IPOs
+
+        for renderer_name in renderer_names:
+            for mode in mode_names:
+                record = {
+                    "version"   : current_version,
+                    "time"      : datetime.now().isoformat(timespec = "seconds"),
+                    "scale"     : name,
+                    "params"    : params,
+                    "html"      : renderer_name,
+                    "writer"    : mode,
+                    "traced"    : trace_memory, ### traced runs are only compared with traced runs
+                }
+                record.update(run_isolated(run_scale, file_path, today, renderer_name, os.path.join(workdir, f"{name}_{renderer_name}_{mode}.xlsx"), trace_memory, mode))
+                body_size = record["body_size"]
+
+                line = f"{name:8s} {renderer_name:10s} {mode:8s} {record['wall']:8.3f}s  body {body_size / 1024:9.1f} KiB"
+                if record["peak_rss"] is not None:
+                    line += f"  rss {record['peak_rss'] / 2**20:7.1f} MiB"
+                if record["writer_peak_rss"] is not None:
+                    line += f"  writer +{record['writer_peak_rss'] / 2**20:6.1f} MiB"
+                matching = [result for result in previous if result["scale"] == name and result["html"] == renderer_name and result["params"] == params
+                            and result.get("writer", "auto") == mode and result.get("traced", True) == trace_memory]
+                if len(matching) > 0 and matching[-1]["wall"] > 0:
+                    line += f"  {record['wall'] / matching[-1]['wall']:.2f}x of {matching[-1]['version']}"
+                print(line)
+
+                with open(results_path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+def scan_lookup(IPO_ID, subscription_raw, limit = None):
+    ### entry_or_not before the Wind code index: one .loc row per subscription row, for every IPO
+    valid_flag = 0
+    invalid_flag = 0
+    allotment_subjects = []
+    for i in subscription_raw.index[:limit]:
+        if subscription_raw.loc[i][main.subscription_dict["ID"]] == IPO_ID:
+            info_dict = {key: None if pd.isna(subscription_raw.loc[i][column]) else subscription_raw.loc[i][column] for key, column in main.subscription_dict.items()}
+            allotment_subjects.append(main.Allotment(info_dict))
+            if main.valid(info_dict["valid"]):
+                valid_flag += 1
+            else:
+                invalid_flag += 1
+    return valid_flag, invalid_flag, allotment_subjects
+
+def subscription_lookup(sizes = (10000, 100000, 1000000), scan_limit = 100000, n_lookups = 20):
+    '''
+    Allotment lookup of one IPO: the old full scan against subscription_index_of + entry_or_not, at each subscription sheet size.
+    The scan is linear in the rows, above scan_limit rows it is timed on the first scan_limit rows and scaled up.
+    '''
+    results = []
+    for size in sizes:
+        _, subscription_raw, _ = generate_sheets(n_IPOs = 200, allotments_per_IPO = -(-size // 160), row_limit = None)
+        subscription_raw = subscription_raw.iloc[:size]
+        subscriptions = main.ingest_frame(subscription_raw, main.subscription_dict)
+        IDs = subscription_raw[main.subscription_dict["ID"]].unique()[:n_lookups]
+
+        start = perf_counter()
+        subscription_index = main.subscription_index_of(subscription_raw)
+        build = perf_counter() - start
+        start = perf_counter()
+        for ID in IDs:
+            entry, allotment_subjects = main.entry_or_not(ID, subscriptions, sort = False, subscription_index = subscription_index)
+        lookup = (perf_counter() - start) / len(IDs)
+
+        limit = min(size, scan_limit)
+        start = perf_counter()
+        valid_flag, invalid_flag, allotments = scan_lookup(IDs[-1], subscription_raw, limit)
+        scan = (perf_counter() - start) * len(subscription_raw.index) / limit
+        if limit == len(subscription_raw.index):
+            assert (valid_flag, valid_flag + invalid_flag) == (int(allotment_subjects.valid_mask().sum()), len(allotment_subjects))
+
+        print(f"{len(subscription_raw.index):8d} rows: index build {build:.3f}s, indexed lookup {lookup * 1000:8.3f} ms/IPO, "
+              f"scan {scan:9.3f} s/IPO{' (scaled from ' + str(limit) + ' rows)' if limit < len(subscription_raw.index) else ''}")
+        results.append({"rows" : len(subscription_raw.index), "build" : build, "lookup" : lookup, "scan" : scan, "scan_rows" : limit})
+    return results
+
+def row_ingest(sheet, field_dict):
+    ### ingestion before ingest(): a deepcopy of field_dict and one .loc row per field, for every row
+    records = []
+    for i in sheet.index:
+        info_dict = copy.deepcopy(field_dict)
+        for key in info_dict.keys():
+            if pd.isna(sheet.loc[i][info_dict[key]]):
+                info_dict[key] = None
+            else:
+                info_dict[key] = sheet.loc[i][info_dict[key]]
+        records.append(info_dict)
+    return records
+
+def ingestion(n_IPOs = 3000, n_subscriptions = 20000):
+    '''
+    IPO and subscription sheet ingestion, row by row against ingest(), on a synthetic sheet of several years of issues
+    (about five announcements per trading day, so 3000 IPOs span some two and a half years).
+    '''
+    IPO_sheet, subscription_sheet, _ = generate_sheets(n_IPOs = n_IPOs, allotments_per_IPO = -(-n_subscriptions // n_IPOs) + 1, row_limit = None)
+    subscription_sheet = subscription_sheet.iloc[:n_subscriptions]
+    results = []
+    for name, sheet, field_dict in (("IPO", IPO_sheet, main.IPO_dict), ("subscription", subscription_sheet, main.subscription_dict)):
+        start = perf_counter()
+        old = row_ingest(sheet, field_dict)
+        by_row = perf_counter() - start
+
+        start = perf_counter()
+        new = main.ingest(sheet, field_dict)
+        columnar = perf_counter() - start
+        assert old == new
+
+        print(f"{name:12s} sheet, {len(sheet.index):6d} rows: row by row {by_row:8.3f}s, ingest {columnar:6.3f}s")
+        results.append({"sheet" : name, "rows" : len(sheet.index), "by_row" : by_row, "columnar" : columnar})
+    return results
+
+class uncached_writer(main.excel_writer):
+    ### excel_writer before the format cache: a new Format for every add_format() call
+    def add_format(self, properties):
+        return self.workbook.add_format(properties)
+
+def format_cache(n_IPOs = 2000, workdir = None):
+    '''
+    generate_IPO_calendar + save() with every one of n_IPOs IPOs in the detail tables, with and without the format cache.
+    Time is taken without tracemalloc, memory is the tracemalloc peak of a second run.
+    '''
+    workdir = tempfile.mkdtemp(prefix = "IPO_formats_") if workdir is None else workdir
+    IPO_sheet, subscription_sheet, workday_sheet = generate_sheets(n_IPOs = n_IPOs, allotments_per_IPO = 5)
+    workdays = workday_sheet.iloc[:, 0].tolist()
+    today = datetime.strptime(str(workdays[len(workdays) // 2]), "%Y%m%d")
+    context = main.run_context(today, IPO_sheet, subscription_sheet, workday_sheet, {}, main.pinyin_cache())
+    data = main.IPO_calendar(context)
+    data.today_IPO["subscription"] = list(data.IPOs) ### the whole sheet goes into the detail tables
+
+    def build(writer_class, path):
+        writer = writer_class(path, context)
+        writer.generate_IPO_calendar(data)
+        writer.save()
+        return len(writer.workbook.formats)
+
+    results = []
+    for name, writer_class in (("uncached", uncached_writer), ("cached", main.excel_writer)):
+        path = os.path.join(workdir, f"calendar_{name}.xlsx")
+        start = perf_counter()
+        n_formats = build(writer_class, path)
+        elapsed = perf_counter() - start
+
+        tracemalloc.start()
+        build(writer_class, path)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        print(f"{n_IPOs} IPOs, {name:8s}: {elapsed:.3f}s, {n_formats:6d} Format objects, peak {peak / 2**20:.1f} MiB")
+        results.append({"n_IPOs" : n_IPOs, "writer" : name, "wall" : elapsed, "formats" : n_formats, "peak" : peak})
+    return results
+
+def scale_workbook(scale_name, workdir):
+    params = scales[scale_name]
+    file_path = os.path.join(workdir, "wind_" + "_".join(f"{key}{value}" for key, value in params.items()) + ".xlsx")
+    if not os.path.exists(file_path):
+        generate_workbook(file_path, **params)
+    return file_path
+
+def workbook_cache(scale_name = "small", workdir = None):
+    '''
+    load_workbook on a synthetic workbook: no cache, a cold cache (parse and store) and a warm cache (no Excel parsing).
+    '''
+    workdir = os.path.join(tempfile.gettempdir(), "IPO_benchmark") if workdir is None else workdir
+    os.makedirs(workdir, exist_ok = True)
+    file_path = scale_workbook(scale_name, workdir)
+    cache_dir = os.path.join(workdir, "cache")
+    main.clear_workbook_cache(cache_dir, file_path)
+
+    timings = {}
+    for name, cache in (("no cache", None), ("cold", cache_dir), ("warm", cache_dir)):
+        start = perf_counter()
+        IPO_raw, subscription_raw, workday_sheet = main.load_workbook(file_path, cache)
+        timings[name] = perf_counter() - start
+    print(f"{scale_name} workbook, {len(subscription_raw.index)} subscription rows: "
+          + ", ".join(f"{name} {elapsed:.3f}s" for name, elapsed in timings.items()))
+    return timings
+
+def three_call_load(file_path):
+    ### the loader before read_workbook: the workbook is opened and parsed once per sheet, every column
+    workday_sheet = pd.read_excel(file_path, sheet_name = 2)
+    IPO_raw = pd.read_excel(file_path, sheet_name = 0)
+    subscription_raw = pd.read_excel(file_path, sheet_name = 1)
+    return IPO_raw, subscription_raw, workday_sheet
+
+def workbook_loader(scale_name = "small", workdir = None):
+    '''
+    Wall time (untraced) and tracemalloc peak of the three-call loader against read_workbook, on a synthetic workbook.
+    '''
+    workdir = os.path.join(tempfile.gettempdir(), "IPO_benchmark") if workdir is None else workdir
+    os.makedirs(workdir, exist_ok = True)
+    file_path = scale_workbook(scale_name, workdir)
+    results = []
+    for name, loader in (("three calls", three_call_load), ("one pass", main.read_workbook)):
+        start = perf_counter()
+        loader(file_path)
+        elapsed = perf_counter() - start
+
+        tracemalloc.start()
+        loader(file_path)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        print(f"{scale_name} workbook, {name:11s}: {elapsed:.3f}s, peak {peak / 2**20:.1f} MiB")
+        results.append({"scale" : scale_name, "loader" : name, "wall" : elapsed, "peak" : peak})
+    return results
+
+def allotment_rows(n_rows, seed = 0):
+    _, subscription_sheet, _ = generate_sheets(n_IPOs = n_rows // 1000 + 2, allotments_per_IPO = 1250, seed = seed, row_limit = None)
+    return main.allotment_table(main.ingest_frame(subscription_sheet, main.subscription_dict).iloc[:n_rows])
+
+def allotment_columns(n_rows, seed = 0, allotments = None):
+    ### the four display columns of today_offering for n_rows synthetic allotment rows
+    allotments = allotment_rows(n_rows, seed) if allotments is None else allotments
+    return [
+        allotments.names,
+        np.char.mod('%.02f', allotments.valid_subscription_amounts),
+        np.char.mod('%.02f', allotments.allotment_amounts),
+        allotments.lockup_labels(),
+    ]
+
+def write_allotments(n_rows, constant_memory, output_path):
+    ### one process per mode: peak RSS growth while n_rows allotment rows go through excel_writer and save()
+    columns = allotment_columns(n_rows)
+    context = SimpleNamespace(today = None, tomorrow = None)
+    reset_peak_rss()
+    base = proc_status("VmRSS")
+    start = perf_counter()
+    writer = main.excel_writer(output_path, context, constant_memory = constant_memory)
+    worksheet = writer.add_worksheet("今日上市")
+    main.write_rows(worksheet, columns, writer.add_format({'border':1, 'align':'center'}))
+    writer.save()
+    elapsed = perf_counter() - start
+    peak = proc_status("VmHWM")
+    return {"n_rows" : len(columns[0]), "constant_memory" : constant_memory, "wall" : elapsed, "rss_growth" : None if peak is None or base is None else peak - base}
+
+def writer_memory(n_rows = 200000, workdir = None):
+    '''
+    excel_writer with and without constant_memory on n_rows allotment rows, each in its own process so that peak RSS is comparable.
+    '''
+    workdir = tempfile.mkdtemp(prefix = "IPO_writer_") if workdir is None else workdir
+    results = []
+    for mode in ("default", "constant"):
+        result = run_isolated(write_allotments, n_rows, writer_modes[mode], os.path.join(workdir, f"allotments_{mode}.xlsx"))
+        growth = "n/a" if result["rss_growth"] is None else f"{result['rss_growth'] / 2**20:.1f} MiB"
+        print(f"{result['n_rows']} rows, {mode:8s}: {result['wall']:.3f}s, peak RSS growth {growth}")
+        results.append(result)
+    return results
+
+def cell_write(worksheet, cols, contents, cell_formats):
+    ### write() before write_row: one worksheet.write per cell
+    for i in range(len(cols)):
+        worksheet[0].write(worksheet[1], cols[i], contents[i], cell_formats[i])
+    worksheet[1] += 1
+
+def bulk_write(n_rows = 200000, workdir = None):
+    '''
+    n_rows allotment rows into a worksheet: a Python list and a list of formats per row written cell by cell,
+    against write_rows straight from the allotment columns. Both include turning the allotments into display values,
+    save() is timed separately, it is the same work for both.
+    '''
+    workdir = tempfile.mkdtemp(prefix = "IPO_bulk_") if workdir is None else workdir
+    allotments = allotment_rows(n_rows)
+    titles = ["配售对象名称", "有效报价的申购数量(万股)", "获配数量(股)", "锁定期(月)"]
+    context = SimpleNamespace(today = None, tomorrow = None)
+
+    results = []
+    for name in ("per cell", "write_rows"):
+        writer = main.excel_writer(os.path.join(workdir, f"bulk_{name.replace(' ', '_')}.xlsx"), context)
+        worksheet = writer.add_worksheet("今日上市")
+        table_cell_format = writer.add_format({'border':1, 'align':'center'})
+        start = perf_counter()
+        if name == "per cell": ### today_offering before the bulk writer
+            for allotment in allotments:
+                contents = [allotment.name, '%.02f'%allotment.valid_subscription_amount, '%.02f'%allotment.allotment_amount]
+                if allotment.lockup_period is not None and int(allotment.lockup_period) == 6:
+                    contents.append(6)
+                elif allotment.lockup_period is not None and int(allotment.lockup_period) == 0:
+                    contents.append("-")
+                else:
+                    contents.append(None)
+                cell_write(worksheet, range(0,len(titles)), contents, [table_cell_format for i in range(len(titles))])
+        else:
+            main.write_rows(worksheet, allotment_columns(n_rows, allotments = allotments), table_cell_format)
+        elapsed = perf_counter() - start
+        start = perf_counter()
+        writer.save()
+        save = perf_counter() - start
+        print(f"{len(allotments)} rows, {name:10s}: write {elapsed:.3f}s, save {save:.3f}s")
+        results.append({"n_rows" : len(allotments), "writer" : name, "write" : elapsed, "save" : save})
+    return results
+
+def ipo_records(n_IPOs = 5000, allotments_per_IPO = 20):
+    '''
+    Construction time and traced memory of n_IPOs IPO objects, without and with a history attached (the daily run has one),
+    and how many of them had to read their subscription rows. Timings are taken in a pass without tracemalloc.
+    '''
+    IPO_sheet, subscription_sheet, workday_sheet = generate_sheets(n_IPOs = n_IPOs, allotments_per_IPO = allotments_per_IPO)
+    workdays = workday_sheet.iloc[:, 0].tolist()
+    today = datetime.strptime(str(workdays[len(workdays) // 2]), "%Y%m%d")
+    subscriptions = main.ingest_frame(subscription_sheet, main.subscription_dict)
+    subscription_index = main.subscription_index_of(subscription_sheet) ### by the Wind column name, positions are shared with subscriptions
+    records = main.ingest(IPO_sheet, main.IPO_dict)
+    statuses = main.entry_status([info_dict["ID"] for info_dict in records], subscriptions)
+
+    def construct(context):
+        return [main.IPO(info_dict, context, subscriptions, subscription_index, status) for info_dict, status in zip(records, statuses)]
+
+    results = []
+    for label, history in (("no history", None), ("history", {})):
+        context = main.run_context(today, IPO_sheet, subscription_sheet, workday_sheet, history, main.pinyin_cache())
+
+        start = perf_counter()
+        IPOs = construct(context)
+        build = perf_counter() - start
+        loaded = sum(ipo._allotment_subjects is not main._UNSET_ for ipo in IPOs)
+
+        tracemalloc.start()
+        IPOs = construct(context)
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        print(f"{n_IPOs} IPOs, {label:10s}: construct {build:.3f}s, {memory / n_IPOs:.0f} B/IPO, {loaded} read their subscription rows")
+        results.append({"n_IPOs" : n_IPOs, "history" : history is not None, "construct" : build, "memory" : memory, "loaded" : loaded})
+    return results
+
+def pinyin_sort(n_names = 50000, workdir = None):
+    '''
+    pinyin order of n_names allotment subject names: with an empty pinyin_cache, again with the same cache,
+    and with a cache saved by one run and loaded by the next.
+    '''
+    workdir = tempfile.mkdtemp(prefix = "IPO_pinyin_") if workdir is None else workdir
+    names = random_names(np.random.default_rng(0), n_names, 6)
+    path = os.path.join(workdir, "pinyin.save")
+
+    cache = main.pinyin_cache(path)
+    start = perf_counter()
+    order = cache.order(names)
+    cold = perf_counter() - start
+
+    start = perf_counter()
+    assert cache.order(names) == order
+    warm = perf_counter() - start
+
+    start = perf_counter()
+    cache.save()
+    loaded = main.pinyin_cache(path)
+    assert loaded.order(names) == order
+    reloaded = perf_counter() - start
+
+    print(f"{n_names} names: cold {cold:.3f}s, warm {warm:.3f}s, save + load + sort {reloaded:.3f}s")
+    return {"n_names" : n_names, "cold" : cold, "warm" : warm, "reloaded" : reloaded}
+
+def active_dedup(sizes = (100, 1000, 10000), events_per_IPO = 4):
+    '''
+    Dedup of today / tomorrow buckets with up to 10k active IPOs: the old list scan against main.unique_IPOs.
+    Every IPO appears in events_per_IPO bucket entries, like an issue that subscribes, pays and lists within the window.
+    '''
+    results = []
+    for size in sizes:
+        IPOs = [SimpleNamespace(ID = f"{i:06d}.SH", online = i % 5 == 0) for i in range(size)]
+        keys = list(main.calendar_dict.keys())
+        buckets = [{key: [] for key in keys}, {key: [] for key in keys}]
+        for i, ipo in enumerate(IPOs):
+            for j in range(events_per_IPO):
+                buckets[(i + j) % 2][keys[(i + j) % len(keys)]].append(ipo)
+
+        start = perf_counter()
+        deduped = list(main.unique_IPOs(buckets))
+        unique = perf_counter() - start
+
+        start = perf_counter()
+        offline = []
+        online = []
+        for bucket in buckets:
+            for key in bucket.keys():
+                for ipo in bucket[key]:
+                    if not ipo.online and ipo not in offline:
+                        offline.append(ipo)
+                    elif ipo.online and ipo not in online:
+                        online.append(ipo)
+        scan = perf_counter() - start
+        assert [ipo for ipo in deduped if not ipo.online] == offline and [ipo for ipo in deduped if ipo.online] == online
+
+        print(f"{size:6d} active IPOs: unique_IPOs {unique * 1000:9.3f} ms, list scan {scan * 1000:9.3f} ms")
+        results.append({"n_IPOs" : size, "unique" : unique, "scan" : scan})
+    return results
+
+class smtp_handler:
+    ### aiosmtpd handler of the SMTP stand-in, counts what it accepted and refuses failure_rate of the messages with a temporary 451
+    def __init__(self, failure_rate = 0.0, seed = 0):
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.received = 0
+        self.refused = 0
+        self.lock = threading.Lock()
+
+    async def handle_DATA(self, server, session, envelope):
+        with self.lock:
+            if self.random.random() < self.failure_rate:
+                self.refused += 1
+                return "451 Requested action aborted: local error in processing"
+            self.received += 1
+        return "250 Message accepted for delivery"
+
+@contextmanager
+def smtp_stand_in(handler):
+    ### a local aiosmtpd server on a free port, yields (host, port)
+    from aiosmtpd.controller import Controller ### only the mail benchmarks and tests need aiosmtpd
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    controller = Controller(handler, hostname = "127.0.0.1", port = port)
+    controller.start()
+    try:
+        yield "127.0.0.1", port
+    finally:
+        controller.stop()
+
+def sample_messages(n_messages):
+    mail_list = ["desk@example.com"]
+    return [(mail_list, main.mail_message("report@example.com", mail_list, MIMEText(f"<p>IPO {i}</p>", 'html', 'utf-8'))) for i in range(n_messages)]
+
+def mail_throughput(n_messages = 200, sizes = (1, 4, 8)):
+    '''
+    Messages per second against a local SMTP stand-in: one connection per message (what class mail does) against mail_pool.send_batch.
+    '''
+    handler = smtp_handler()
+    messages = sample_messages(n_messages)
+    results = []
+    with smtp_stand_in(handler) as (host, port):
+        start = perf_counter()
+        for mail_list, msg in messages:
+            SMTP_server = smtplib.SMTP(host, port)
+            SMTP_server.sendmail("report@example.com", mail_list, msg.as_string())
+            SMTP_server.quit()
+        elapsed = perf_counter() - start
+        print(f"one connection per message: {n_messages / elapsed:8.1f} messages/s")
+        results.append({"pool" : None, "sent" : n_messages, "rate" : n_messages / elapsed})
+
+        for size in sizes:
+            pool = main.mail_pool("report@example.com", None, host, port, size = size)
+            start = perf_counter()
+            sent = sum(pool.send_batch(messages))
+            elapsed = perf_counter() - start
+            pool.close()
+            print(f"mail_pool size {size:2d}:          {sent / elapsed:8.1f} messages/s, {sent}/{n_messages} delivered")
+            results.append({"pool" : size, "sent" : sent, "rate" : sent / elapsed})
+    assert handler.received == n_messages * (len(sizes) + 1)
+    return results
+
+
+def flaky_spool(n_messages = 100, failure_rate = 0.3, workdir = None, timeout = 120):
+    '''
+    mail_spool against a stand-in that refuses failure_rate of the deliveries: how long the queue takes to drain,
+    how many attempts failed and the put() to delivery latency. Backoff delays are scaled down to milliseconds.
+    '''
+    workdir = tempfile.mkdtemp(prefix = "IPO_spool_") if workdir is None else workdir
+    handler = smtp_handler(failure_rate)
+    with smtp_stand_in(handler) as (host, port), redirect_stdout(io.StringIO()): ### mail_pool prints every refused delivery
+        pool = main.mail_pool("report@example.com", None, host, port)
+        spool = main.mail_spool(workdir, pool, base_delay = 0.01, max_delay = 0.2, max_attempts = 30, poll = 0.01)
+        start = perf_counter()
+        for mail_list, msg in sample_messages(n_messages):
+            spool.put(mail_list, msg)
+        spool.start()
+        while spool.queue_depth() > 0 and perf_counter() - start < timeout:
+            time.sleep(0.01)
+        spool.stop()
+        elapsed = perf_counter() - start
+        pool.close()
+
+    stats = spool.stats()
+    stats.update({"n_messages" : n_messages, "failure_rate" : failure_rate, "received" : handler.received, "refused" : handler.refused, "elapsed" : elapsed})
+    print(f"{n_messages} messages, {failure_rate:.0%} refused: drained in {elapsed:.2f}s, {stats['delivered']} delivered, "
+          f"{stats['failed_attempts']} failed attempts, {stats['given_up']} given up, latency mean {stats['latency_mean']:.3f}s max {stats['latency_max']:.3f}s")
+    return stats
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = "full-pipeline benchmark on synthetic Wind workbooks")
+    parser.add_argument("--scales", default = ",".join(scales.keys()), help = "comma separated, from: " + ", ".join(scales.keys()))
+    parser.add_argument("--html", default = ",".join(renderers.keys()), help = "comma separated, from: " + ", ".join(renderers.keys()))
+    parser.add_argument("--results", default = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_results.jsonl"))
+    parser.add_argument("--workdir", default = os.path.join(tempfile.gettempdir(), "IPO_benchmark"))
+    parser.add_argument("--writer", default = "auto", help = "comma separated excel_writer modes, from: " + ", ".join(writer_modes.keys()) + "; default,constant compares peak RSS")
+    parser.add_argument("--trace-memory", action = "store_true", help = "tracemalloc peaks per stage, wall and CPU times then include its overhead")
+    parser.add_argument("--ipo-records", type = int, metavar = "N", help = "only measure construction of N IPO objects")
+    parser.add_argument("--dedup", action = "store_true", help = "only measure the active-IPO dedup, up to 10k IPOs")
+    parser.add_argument("--mail", type = int, metavar = "N", help = "only measure mail_pool throughput with N messages, needs aiosmtpd")
+    parser.add_argument("--flaky-spool", type = float, metavar = "RATE", help = "only drain 100 spooled messages through a stand-in that refuses RATE of them")
+    parser.add_argument("--pinyin", type = int, metavar = "N", help = "only measure cold / warm pinyin sorting of N names")
+    parser.add_argument("--writer-memory", type = int, metavar = "N", help = "only compare peak RSS of default / constant_memory writes of N allotment rows")
+    parser.add_argument("--lookup", action = "store_true", help = "only compare the subscription scan and the indexed lookup at 10k / 100k / 1M rows")
+    parser.add_argument("--ingestion", action = "store_true", help = "only compare row-by-row and columnar sheet ingestion")
+    parser.add_argument("--formats", type = int, metavar = "N", help = "only compare workbook build with and without the format cache on N IPOs")
+    parser.add_argument("--workbook-cache", metavar = "SCALE", help = "only compare cold and warm load_workbook on the workbook of SCALE")
+    parser.add_argument("--loader", metavar = "SCALE", help = "only compare the three-call and one-pass workbook loaders on the workbook of SCALE")
+    parser.add_argument("--bulk-write", type = int, metavar = "N", help = "only compare per-cell and write_rows writes of N allotment rows")
+    args = parser.parse_args()
+
+    if args.ipo_records:
+        ipo_records(args.ipo_records)
+    elif args.dedup:
+        active_dedup()
+    elif args.lookup:
+        subscription_lookup()
+    elif args.workbook_cache:
+        workbook_cache(args.workbook_cache)
+    elif args.loader:
+        workbook_loader(args.loader)
+    elif args.formats:
+        format_cache(args.formats)
+    elif args.ingestion:
+        ingestion()
+    elif args.writer_memory:
+        writer_memory(args.writer_memory)
+    elif args.bulk_write:
+        bulk_write(args.bulk_write)
+    elif args.pinyin:
+        pinyin_sort(args.pinyin)
+    elif args.mail:
+        mail_throughput(args.mail)
+    elif args.flaky_spool is not None:
+        flaky_spool(failure_rate = args.flaky_spool)
+    else:
+        benchmark(args.scales.split(","), args.html.split(","), args.results, args.workdir, args.trace_memory, args.writer.split(","))
@@ -1,8 +1,23 @@
 import os
 import re
-import copy
+import sys
+import queue
+import threading
+import json
+import time
+import uuid
+import cProfile
+import tracemalloc
+import hashlib
+import tempfile
+import argparse
+import bisect
+
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
 
 from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd 
@@ -16,9 +31,11 @@ from pypinyin import lazy_pinyin
 import smtplib
 from email.mime.multipart import MIMEMultipart
 from email.utils import formataddr
+from email import message_from_bytes
 from email.mime.text import MIMEText 
 from email.mime.application import MIMEApplication
 
+from html import escape
 from HTMLTable import HTMLTable
 
 from corner_case import lower_hold_special_case, lottery_date_special_case, entry_special_case
@@ -56,6 +73,16 @@ subscription_dict = {
     "subscription_amount"         : "申报数量", ### Subscription Amount
 }
 
+date_fields = [
+    "announcement_date",
+    "inquiry_date",
+    "offline_subscription_date",
+    "offline_payment_date",
+    "offering_date",
+    "online_subscription_date",
+    "online_payment_date",
+]
+
 calendar_dict = {
     "material_submitting"         : "交材",
     "inquiry"                     : "报价",
@@ -71,14 +98,42 @@ _SMALLMEDIUMBOARD_ =1 ### small and medium board
 _SNTINNOVATIONBOARD_ = 2 ### S&T innovation board
 _SECONDBOARD_ = 3 ### second board
 
+_UNSET_ = object() ### lazily computed field that has not been computed yet
+
 _PAST_ = 0
 _TODAY_ = 1
 _TOMORROW_ =2
 _FUTURE_ = 3
 
+date_colors = {
+    _PAST_                        : '#C0C0C0',
+    _TODAY_                       : '#DC143C',
+    _TOMORROW_                    : '#CD7F32',
+}
+
+entry_labels = {
+    0                             : "入围",
+    1                             : "部分入围",
+    2                             : "未入围",
+}
 
 
 
+
+def ingest_frame(sheet, field_dict):
+    ### the Wind columns of field_dict, renamed to its keys in one pass
+    keys = list(field_dict.keys())
+    frame = sheet[[field_dict[key] for key in keys]]
+    frame.columns = keys
+    return frame
+
+def ingest(sheet, field_dict):
+    ### one record per row, NaN normalized to None once for the whole sheet
+    keys = list(field_dict.keys())
+    frame = ingest_frame(sheet, field_dict).astype(object)
+    frame = frame.where(pd.notna(frame), None)
+    return [dict(zip(keys, row)) for row in frame.itertuples(index=False, name=None)]
+
 def online(string):
     if re.search("网下", string) is None:
         return True
@@ -115,65 +170,133 @@ def date_str(date):
     else: ### to handle the case that date type is np.float
         return str(int(date))
 
-def next_workday(date, workday_sheet, data=True):
-    next_workday = None
-    if data:
-        index = -1
-        for i in workday_sheet.index:
-            if workday_sheet.loc[i][0] == date:
-                index = i+1
-        if index < len(workday_sheet.index) and index != -1:
-            next_workday = workday_sheet.loc[index][0]
+def weekday_offset(date, n):
+    dateStr = date_str(date)
+    date = datetime(int(dateStr[:4]), int(dateStr[4:6]), int(dateStr[6:8]))
+    step = 1 if n > 0 else -1
+    for _ in range(abs(n)):
+        date += timedelta(days = step)
+        while date.weekday() >= 5: ### 0: Mon, ..., 6: Sun
+            date += timedelta(days = step)
+
+    '''
+    Official holiday cases have not implemented!!!
+    '''
+    return int(date_str(date))
+
+
+class trading_calendar:
+    def __init__(self, workday_sheet):
+        dates = [int(date_str(date)) for date in workday_sheet.iloc[:, 0] if not pd.isna(date)]
+        self.workdays = np.unique(np.array(dates, dtype=np.int64)) ### sorted and deduplicated
+
+    def in_range(self, date):
+        return len(self.workdays) > 0 and self.workdays[0] <= date <= self.workdays[-1]
+
+    def nth(self, date, n):
+        date = int(date_str(date))
+        if n == 0:
+            return date
+        if not self.in_range(date): ### outside the workday sheet, fall back to the weekday rule
+            return weekday_offset(date, n)
+
+        if n > 0:
+            index = np.searchsorted(self.workdays, date, side='right') + n - 1
         else:
-            dateStr = date_str(date)
-            date = datetime(int(dateStr[:4]), int(dateStr[4:6]), int(dateStr[6:8]))
-            weekday = date.weekday() ### 0: Mon, ..., 6: Sun
-            interval = 1
-            if weekday >= 4:
-                interval += 6-weekday
-
-            next_workday = date + timedelta(days = interval)
-    else:
-        dateStr = date_str(date)
-        date = datetime(int(dateStr[:4]), int(dateStr[4:6]), int(dateStr[6:8]))
-        weekday = date.weekday() ### 0: Mon, ..., 6: Sun
-        interval = 1
-        if weekday >= 4:
-            interval += 6-weekday
+            index = np.searchsorted(self.workdays, date, side='left') + n
+        if 0 <= index < len(self.workdays):
+            return int(self.workdays[index])
 
-        '''
-        Official holiday cases have not implemented!!!
-        '''
-        pass
+        ### ran off the end of the sheet, continue from its boundary with the weekday rule
+        if n > 0:
+            return weekday_offset(self.workdays[-1], index - (len(self.workdays)-1))
+        else:
+            return weekday_offset(self.workdays[0], index)
+
+    def next(self, date):
+        return self.nth(date, 1)
+
+    def previous(self, date):
+        return self.nth(date, -1)
+
+    def offset(self, dates, n):
+        ### T+n for a whole column at once, None / str / NaN entries give NaN
+        dates = pd.to_numeric(pd.Series(list(dates), dtype=object), errors='coerce').to_numpy(dtype=np.float64)
+        result = np.full(len(dates), np.nan)
+        known = np.flatnonzero(~np.isnan(dates))
+        values = dates[known].astype(np.int64)
+        if len(self.workdays) == 0 or n == 0:
+            result[known] = [self.nth(value, n) for value in values]
+            return result
+
+        if n > 0:
+            index = np.searchsorted(self.workdays, values, side='right') + n - 1
+        else:
+            index = np.searchsorted(self.workdays, values, side='left') + n
+        hit = (values >= self.workdays[0]) & (values <= self.workdays[-1]) & (index >= 0) & (index < len(self.workdays))
+        result[known[hit]] = self.workdays[index[hit]]
+        for i in np.flatnonzero(~hit): ### rare, dates around or beyond the sheet boundary
+            result[known[i]] = self.nth(values[i], n)
+        return result
 
-        next_workday = date + timedelta(days = interval)
 
-    return int(date_str(next_workday))
+def next_workday(date, workday_sheet, data=True):
+    if not data:
+        return weekday_offset(date, 1)
+    if not isinstance(workday_sheet, trading_calendar):
+        workday_sheet = trading_calendar(workday_sheet)
+    return workday_sheet.next(date)
+
+
+class run_context:
+    ### everything one calendar build depends on, so several dates can be built side by side
+    def __init__(self, today, IPO_raw, subscription_raw, workday_sheet, history = None, pinyin_keys = None, tomorrow = None):
+        if isinstance(workday_sheet, trading_calendar):
+            self.workday_calendar = workday_sheet
+        else:
+            self.workday_calendar = trading_calendar(workday_sheet)
+        if tomorrow is None:
+            tomorrow = self.workday_calendar.next(today)
+        self.today = date_str(today)
+        self.tomorrow = date_str(tomorrow)
+        self.IPO_raw = IPO_raw
+        self.subscription_raw = subscription_raw
+        self.history = history
+        self.pinyin_keys = pinyin_keys
+
 
-def date_type(date):
-    global today, tomorrow ### read only, not allow to modify
+def classify_dates(dates, today, tomorrow):
     global _PAST_, _TODAY_, _TOMORROW_, _FUTURE_ ### read only, not allow to modify
+    ### _PAST_ / _TODAY_ / _TOMORROW_ / _FUTURE_ for a whole column, -1 for None / str / between today and tomorrow
     _today = int(date_str(today))
     _tomorrow = int(date_str(tomorrow))
-    if isinstance(date, str):
-        return -1
-    elif date is None:
-        return -1
-    else:
-        if int(date) == _today:
-            return _TODAY_
-        elif int(date) == _tomorrow:
-            return _TOMORROW_
-        elif int(date) < _today:
-            return _PAST_
-        elif int(date) > _tomorrow:
-            return _FUTURE_
-
+    dates = pd.Series(list(dates), dtype=object)
+    numeric = dates.map(lambda date: date is not None and not isinstance(date, str)).to_numpy(dtype=bool)
+    values = pd.to_numeric(dates.where(numeric), errors='coerce').to_numpy(dtype=np.float64)
+    values = np.trunc(values) ### same as int(date)
 
+    codes = np.full(len(values), -1, dtype=np.int8)
+    codes[values < _today] = _PAST_
+    codes[values == _today] = _TODAY_
+    codes[values == _tomorrow] = _TOMORROW_
+    codes[values > _tomorrow] = _FUTURE_
+    return codes
 
 
 class IPO:
-    def __init__(self, info_dict, subscription_sheet, workday_sheet, history=None):
+    '''
+    Derived fields (board_type, lottery_date, entry, allotment_subjects, IPO_name) are computed on first access and cached,
+    so IPOs outside the today / tomorrow window cost little more than their raw fields.
+    '''
+    __slots__ = [
+        "ID", "announcement_date", "inquiry_date", "offline_subscription_date", "offline_payment_date", "offering_date",
+        "purchase_limit", "offline_purchase_limit", "funding", "issued_share", "price", "online_purchase_limit",
+        "online_subscription_date", "online_payment_date", "online", "raw_name",
+        "entry_status", "context", "subscriptions", "subscription_index",
+        "_board_type", "_lottery_date", "_entry", "_allotment_subjects", "_sorted", "_IPO_name",
+    ]
+
+    def __init__(self, info_dict, context, subscriptions, subscription_index=None, entry_status=None):
         self.ID = info_dict["ID"]
         self.announcement_date = info_dict["announcement_date"]
         self.inquiry_date = info_dict["inquiry_date"]
@@ -190,42 +313,97 @@ class IPO:
         self.online_payment_date = info_dict["online_payment_date"]
 
         self.online = online(info_dict["online"]) ### True / False
-
-        self.lottery_date = self.cal_lottery_date(workday_sheet)
-        self.entry = -1 ### default -1 (which means it is unnecessary to consider); 0 entried; 1 partly entried; 2 not entried
-        self.allotment_subjects = []
-
-        global today, tomorrow ### read only, not allow to modify
-        if date_str(self.offline_subscription_date) == date_str(today) or date_str(self.offline_subscription_date) == date_str(tomorrow):
-            self.entry, self.allotment_subjects = entry_or_not(self.ID, subscription_sheet)
-        elif date_str(self.offline_subscription_date) == date_str(tomorrow) or date_str(self.offering_date) == date_str(today):
-            _, self.allotment_subjects = entry_or_not(self.ID, subscription_sheet)
-
-
+        self.raw_name = info_dict["IPO_name"]
+        self.entry_status = entry_status ### entry code from the batch entry_status(), whatever the dates; None if not given
+
+        self.context = context
+        self.subscriptions = subscriptions
+        self.subscription_index = subscription_index
+
+        self._board_type = _UNSET_
+        self._lottery_date = _UNSET_
+        self._entry = _UNSET_
+        self._allotment_subjects = _UNSET_
+        self._sorted = False
+        self._IPO_name = _UNSET_
+
+        if context.history is not None:
+            self.IPO_name ### resolved now so that every IPO updates the history, as before
+
+    @property
+    def board_type(self):
+        if self._board_type is _UNSET_:
+            self._board_type = parse_ID(self.ID)
+        return self._board_type
+
+    @property
+    def lottery_date(self):
+        if self._lottery_date is _UNSET_:
+            self._lottery_date = self.cal_lottery_date(self.context.workday_calendar)
+        return self._lottery_date
+
+    @property
+    def entry(self):
+        ### -1 (which means it is unnecessary to consider); 0 entried; 1 partly entried; 2 not entried
+        if self._entry is _UNSET_:
+            if not self.subscribing():
+                self._entry = -1 ### decided from the dates alone, no subscription rows are read
+            elif self.entry_status is not None:
+                self._entry = int(self.entry_status)
+            else:
+                self._entry, self._allotment_subjects = entry_or_not(self.ID, self.subscriptions, sort=False, subscription_index=self.subscription_index)
+        return self._entry
+
+    @property
+    def allotment_subjects(self):
+        if self._allotment_subjects is _UNSET_:
+            if self.subscribing() or date_str(self.offering_date) == self.context.today:
+                self._allotment_subjects = allotments_of(self.ID, self.subscriptions, self.subscription_index)
+            else:
+                self._allotment_subjects = allotment_table.empty()
+        if not self._sorted:
+            if len(self._allotment_subjects) > 0:
+                self._allotment_subjects = self._allotment_subjects.sort(self.context.pinyin_keys)
+            self._sorted = True
+        return self._allotment_subjects
+
+    @property
+    def IPO_name(self):
+        if self._IPO_name is _UNSET_:
+            self._IPO_name = self.resolve_name(self.context.history)
+        return self._IPO_name
+
+    def subscribing(self):
+        ### offline subscription today or tomorrow, the only IPOs whose entry is considered
+        offline_subscription_date = date_str(self.offline_subscription_date)
+        return offline_subscription_date == self.context.today or offline_subscription_date == self.context.tomorrow
+
+    def resolve_name(self, history):
         ### online and partly/not entried flags are mutually exclusive
         if self.ID in entry_special_case:
-            self.IPO_name = entry_special_case[self.ID]
+            IPO_name = entry_special_case[self.ID]
             if history is not None:
-                history[self.ID] = self.IPO_name
+                history[self.ID] = IPO_name
         elif self.online:
-            self.IPO_name = info_dict["IPO_name"] + "（网上）"
+            IPO_name = self.raw_name + "（网上）"
         elif self.entry == 1:
-            self.IPO_name = info_dict["IPO_name"] + "（部分入围）"
+            IPO_name = self.raw_name + "（部分入围）"
         elif self.entry == 2:
-            self.IPO_name = info_dict["IPO_name"] + "（未入围）"
+            IPO_name = self.raw_name + "（未入围）"
+        elif history is not None and self.entry != 0:
+            IPO_name = history.setdefault(self.ID, self.raw_name) ### the remembered name, otherwise remember this one
         elif history is not None and history.__contains__(self.ID):
-            self.IPO_name = history[self.ID]
+            IPO_name = history[self.ID]
         else:
-            self.IPO_name = info_dict["IPO_name"]
-
-        if history is not None and self.entry != 0:
-            history[self.ID] = self.IPO_name ### this works in python, the history dictionary passed in will be updated
-
+            IPO_name = self.raw_name
 
+        if history is not None and self.entry != 0 and history.get(self.ID) != IPO_name:
+            history[self.ID] = IPO_name ### this works in python, the history dictionary passed in will be updated
+        return IPO_name
 
-    def cal_lottery_date(self, workday_sheet):
+    def cal_lottery_date(self, workday_calendar):
         global _MAINBOARD_, _SMALLMEDIUMBOARD_, _SNTINNOVATIONBOARD_, _SECONDBOARD_ ### read only, not allow to modify
-        board_type = parse_ID(self.ID)
+        board_type = self.board_type
         if self.ID in lottery_date_special_case:
             return lottery_date_special_case[self.ID]
         if board_type == _MAINBOARD_ or board_type == _SMALLMEDIUMBOARD_:
@@ -233,7 +411,7 @@ class IPO:
         if self.online:
             return None
         elif board_type == _SNTINNOVATIONBOARD_:
-            return next_workday(self.offline_payment_date, workday_sheet)
+            return workday_calendar.next(self.offline_payment_date)
         elif board_type == _SECONDBOARD_:
             return "10%比例限售锁定"
 
@@ -245,30 +423,186 @@ def pinyin(chinese_str):
         pinyin_str += char
     return pinyin_str
 
-def entry_or_not(IPO_ID, subscription_sheet, sort=True):
-    entry = -1
-    allotment_subjects = []
-    valid_flag = 0 
-    invalid_flag = 0
-
+def subscription_index_of(subscription_sheet):
     global subscription_dict ### read only, not allow to modify
+    ### Wind code -> row positions of the subscription sheet, built once per sheet
+    return subscription_sheet.groupby(subscription_dict["ID"], sort=False).indices
+
+def write_atomic(path, write, mode='wb', encoding=None):
+    ### write(f) fills a temp file next to path, which replaces path only once it is on disk:
+    ### a crash leaves either the old or the new file, and concurrent writers never share a temp file
+    temp_path = f"{path}.{os.getpid()}_{uuid.uuid4().hex[:8]}.tmp"
+    try:
+        with open(temp_path, mode, encoding=encoding) as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+class pinyin_cache:
+    def __init__(self, path=None, capacity=100000):
+        self.path = path
+        self.capacity = capacity
+        self.keys = OrderedDict() ### name -> pinyin, least recently used first
+        self.updated = False
+        self.lock = threading.Lock() ### shared by calendars built in parallel threads
+        if path is not None and os.path.exists(path):
+            self.keys.update(joblib.load(path))
+
+    def key(self, name):
+        with self.lock:
+            if self.keys.__contains__(name):
+                self.keys.move_to_end(name)
+                return self.keys[name]
+        key = pinyin(name)
+        with self.lock:
+            self.keys[name] = key
+            self.updated = True
+            if len(self.keys) > self.capacity:
+                self.keys.popitem(last=False)
+        return key
+
+    def order(self, names):
+        ### positions of names in pinyin order, every distinct name is looked up once
+        keys = {}
+        for name in names:
+            if not keys.__contains__(name):
+                keys[name] = self.key(name)
+        return sorted(range(len(names)), key=lambda i: keys[names[i]])
 
-    for i in subscription_raw.index:
-        info_dict = copy.deepcopy(subscription_dict)
-        ID = subscription_raw.loc[i][info_dict["ID"]]
-        if ID == IPO_ID:
-            for key in info_dict.keys():
-                if pd.isna(subscription_raw.loc[i][info_dict[key]]):
-                    info_dict[key] = None
-                else:
-                    info_dict[key] = subscription_raw.loc[i][info_dict[key]]
-            allotment_subjects.append(Allotment(info_dict))
-            if valid(info_dict["valid"]):
-                valid_flag += 1
-            else:
-                invalid_flag += 1
+    def save(self):
+        with self.lock:
+            if self.path is not None and self.updated:
+                write_atomic(self.path, lambda f: joblib.dump(self.keys, f))
+                self.updated = False
+
+class history_store:
+    def __init__(self, path, legacy_path=None, compact_ratio=2):
+        ### append-only log of [ID, IPO_name] lines, the last line of an ID wins
+        self.path = path
+        self.compact_ratio = compact_ratio
+        self.entries = {}
+        self.records = 0
+        self.log = None
+        if os.path.exists(path):
+            torn = False
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        ID, IPO_name = json.loads(line)
+                    except ValueError: ### interrupted write, the entry was never committed
+                        torn = True
+                        continue
+                    torn = torn or not line.endswith("\n")
+                    self.entries[ID] = IPO_name
+                    self.records += 1
+            if torn:
+                self.compact()
+        elif legacy_path is not None and os.path.exists(legacy_path):
+            self.entries = dict(joblib.load(legacy_path)) ### one-time migration from history.save
+            self.compact()
+
+    def __contains__(self, ID):
+        return self.entries.__contains__(ID)
+
+    def __getitem__(self, ID):
+        return self.entries[ID]
+
+    def __setitem__(self, ID, IPO_name):
+        if self.entries.__contains__(ID) and self.entries[ID] == IPO_name:
+            return ### only changed entries are written
+        self.entries[ID] = IPO_name
+        if self.log is None:
+            self.log = open(self.path, 'a', encoding='utf-8')
+        self.log.write(json.dumps([ID, IPO_name], ensure_ascii=False) + "\n")
+        self.log.flush()
+        self.records += 1
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, ID, default=None):
+        return self.entries.get(ID, default)
+
+    def setdefault(self, ID, IPO_name):
+        if not self.entries.__contains__(ID):
+            self[ID] = IPO_name
+        return self.entries[ID]
+
+    def copy(self):
+        return dict(self.entries)
+
+    def compact(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+        def write(f):
+            for ID, IPO_name in self.entries.items():
+                f.write(json.dumps([ID, IPO_name], ensure_ascii=False) + "\n")
+        write_atomic(self.path, write, 'w', encoding='utf-8')
+        self.records = len(self.entries)
+
+    def close(self):
+        if self.records > self.compact_ratio * max(len(self.entries), 1):
+            self.compact()
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+
+class history_recorder(dict):
+    ### records the writes IPO.__init__ makes, so they can be replayed onto another history in date order
+    def __init__(self):
+        super().__init__()
+        self.ops = []
+
+    def __setitem__(self, ID, IPO_name):
+        self.ops.append(("set", ID, IPO_name))
+        super().__setitem__(ID, IPO_name)
+
+    def setdefault(self, ID, IPO_name):
+        self.ops.append(("setdefault", ID, IPO_name))
+        return super().setdefault(ID, IPO_name)
+
+def replay_history(history, ops):
+    for op, ID, IPO_name in ops:
+        if op == "set":
+            history[ID] = IPO_name
         else:
-            continue
+            history.setdefault(ID, IPO_name)
+
+
+def allotments_of(IPO_ID, subscriptions, subscription_index=None):
+    if subscription_index is None:
+        return allotment_table(subscriptions[(subscriptions["ID"] == IPO_ID).to_numpy()])
+    return allotment_table(subscriptions.take(subscription_index.get(IPO_ID, [])))
+
+def entry_status(IPO_IDs, subscriptions):
+    '''
+    The entry code of every IPO_ID at once (-1, 0, 1, 2 as in entry_or_not), from one groupby of the valid column by Wind code.
+    '''
+    valid = (subscriptions["valid"] == "有效").to_numpy()
+    counts = pd.DataFrame({"ID": subscriptions["ID"].to_numpy(), "valid": valid, "invalid": ~valid}).groupby("ID", sort=False).sum()
+    counts = counts.reindex(pd.Index(IPO_IDs), fill_value=0)
+    valid_flag = counts["valid"].to_numpy()
+    invalid_flag = counts["invalid"].to_numpy()
+    return np.select(
+        [(valid_flag > 0) & (invalid_flag == 0), (valid_flag > 0) & (invalid_flag > 0), (valid_flag == 0) & (invalid_flag > 0)],
+        [0, 1, 2], ### entried, partly entried, not entried
+        -1,
+    ).astype(np.int8)
+
+def entry_or_not(IPO_ID, subscriptions, sort=True, subscription_index=None, pinyin_keys=None):
+    entry = -1
+
+    allotment_subjects = allotments_of(IPO_ID, subscriptions, subscription_index)
+
+    valid_flag = int(allotment_subjects.valid_mask().sum())
+    invalid_flag = len(allotment_subjects) - valid_flag
 
     if valid_flag > 0 and invalid_flag == 0:
         entry = 0 ### entried
@@ -279,9 +613,7 @@ def entry_or_not(IPO_ID, subscription_sheet, sort=True):
 
 
     if sort:
-        allotment_subjects.sort(key=lambda allotment: pinyin(allotment.name))
-
-
+        allotment_subjects = allotment_subjects.sort(pinyin_keys)
 
     return entry, allotment_subjects
 
@@ -298,83 +630,541 @@ class Allotment():
         self.valid = valid(info_dict["valid"])
         self.subscription_amount = info_dict["subscription_amount"]
 
-class IPO_calendar():
-    def __init__(self, IPO_raw, subscription_raw, workday_sheet, history = None):
-        global today, tomorrow ### read only, not allow to modify
-        self.today = date_str(today)
-        self.tomorrow = date_str(tomorrow)
-        self.IPO_sheet = IPO_raw
-        self.subscription_sheet = subscription_raw
-        self.workday_sheet = workday_sheet
-
-        self.today_IPO = {"material_submitting":[], "inquiry":[], "subscription":[], "payment":[], "lottery":[], "offering":[]}
-        self.tomorrow_IPO = {"inquiry":[], "subscription":[], "payment":[], "lottery":[], "offering":[]}
-
-        for i in self.IPO_sheet.index:
-            info_dict = copy.deepcopy(IPO_dict)
-            for key in info_dict.keys():
-                if pd.isna(self.IPO_sheet.loc[i][info_dict[key]]):
-                    info_dict[key] = None
-                else:
-                    '''
-                    The data types of raw sheet have not aligned.
-                    Some date info is np.float64 type. Therefore, they need to be handle separately
 
-                    '''
-                    info_dict[key] = self.IPO_sheet.loc[i][info_dict[key]]
+class allotment_table:
+    '''
+    The allotment subjects of one IPO, a slice of the subscription sheet with subscription_dict keys as columns.
+    Columns are read as arrays; iterating yields Allotment objects one at a time.
+    '''
+    def __init__(self, frame):
+        self.frame = frame
 
-            ipo = IPO(info_dict, self.subscription_sheet, self.workday_sheet, history)
-            self.parse_IPO_date(ipo)
-            
+    @staticmethod
+    def empty():
+        return empty_allotments ### shared, tables are never modified in place
+
+    def __len__(self):
+        return len(self.frame.index)
+
+    def __iter__(self):
+        keys = list(self.frame.columns)
+        for row in self.frame.itertuples(index=False, name=None):
+            yield Allotment({key: None if pd.isna(value) else value for key, value in zip(keys, row)})
 
+    def column(self, key):
+        ### object array, NaN as None like the rest of the report
+        values = self.frame[key].to_numpy(dtype=object)
+        values[pd.isna(values)] = None
+        return values
 
+    def valid_mask(self):
+        return (self.frame["valid"] == "有效").to_numpy()
 
-    def parse_IPO_date(self, ipo):
-        if date_str(ipo.announcement_date) == self.today:
-            self.today_IPO["material_submitting"].append(ipo)
+    def valid_only(self):
+        return allotment_table(self.frame[self.valid_mask()])
+
+    def sort(self, pinyin_keys = None):
+        names = self.frame["allotment_subject_name"].tolist()
+        if pinyin_keys is not None:
+            order = pinyin_keys.order(names)
+        else:
+            keys = [pinyin(name) for name in names]
+            order = sorted(range(len(names)), key=keys.__getitem__) ### stable, same as list.sort
+        return allotment_table(self.frame.take(order))
+
+    @property
+    def names(self):
+        return self.column("allotment_subject_name")
+
+    @property
+    def quotes(self):
+        return self.column("quote")
+
+    @property
+    def subscription_amounts(self):
+        return self.column("subscription_amount")
+
+    @property
+    def valid_subscription_amounts(self):
+        return self.frame["valid_subscription_amount"].to_numpy(dtype=np.float64)
+
+    @property
+    def allotment_amounts(self):
+        return self.frame["allotment_amount"].to_numpy(dtype=np.float64)
+
+    @property
+    def lockup_periods(self):
+        return self.frame["lockup_period"].to_numpy(dtype=np.float64)
+
+    def lockup_split_amounts(self):
+        ### second board: 10% of the valid amount is locked up for 6 months, 90% is not
+        amounts = self.valid_subscription_amounts
+        return np.where(self.lockup_periods == 6, amounts*0.1, amounts*0.9)
+
+    def lockup_labels(self):
+        lockup_periods = self.lockup_periods
+        labels = np.full(len(lockup_periods), None, dtype=object)
+        labels[lockup_periods == 6] = 6
+        labels[lockup_periods == 0] = "-"
+        return labels
+
+empty_allotments = allotment_table(pd.DataFrame(columns = list(subscription_dict.keys())))
+
+class pricing_table:
+    '''
+    Price estimate, 底仓要求 and the offline / online application caps of every IPO in the sheet, computed column-wise in one pass.
+    A value that can not be computed is NaN (None for holder), and the missing_* masks say which input was missing.
+    '''
+    def __init__(self, IPO_frame):
+        global _MAINBOARD_, _SMALLMEDIUMBOARD_, _SNTINNOVATIONBOARD_, _SECONDBOARD_ ### read only, not allow to modify
+
+        self.IDs = IPO_frame["ID"].to_numpy(dtype=object)
+        self.rows = {}
+        for row, ID in enumerate(self.IDs):
+            self.rows.setdefault(ID, row) ### first occurrence, like the IPO objects
+
+        prefixes = IPO_frame["ID"].astype(str).str[:2].to_numpy()
+        self.board_types = np.select(
+            [prefixes == "60", prefixes == "00", prefixes == "68", prefixes == "30"],
+            [_MAINBOARD_, _SMALLMEDIUMBOARD_, _SNTINNOVATIONBOARD_, _SECONDBOARD_],
+            -1,
+        )
+        mainboard = (self.board_types == _MAINBOARD_) | (self.board_types == _SMALLMEDIUMBOARD_)
+        lower_hold = (self.board_types == _SNTINNOVATIONBOARD_) | (self.board_types == _SECONDBOARD_) | np.isin(self.IDs, lower_hold_special_case)
+        self.online = ~IPO_frame["online"].astype(str).str.contains("网下").to_numpy()
+
+        price = self.numeric(IPO_frame["price"])
+        funding = self.numeric(IPO_frame["funding"])
+        issued_share = self.numeric(IPO_frame["issued_share"])
+        offline_purchase_limit = self.numeric(IPO_frame["offline_purchase_limit"])
+        online_purchase_limit = self.numeric(IPO_frame["online_purchase_limit"])
+
+        ### 60/00 without a price are estimated from funding / issued_share, 68/30 are left empty
+        with np.errstate(divide='ignore', invalid='ignore'):
+            estimate = np.where(mainboard, funding / issued_share, np.nan)
+        estimate[~np.isfinite(estimate)] = np.nan
+        unpriced = np.isnan(price)
+        self.prices = np.round(np.where(unpriced, estimate, price), 2)
+        self.missing_funding = unpriced & mainboard & np.isnan(funding)
+        self.missing_issued_share = unpriced & mainboard & ~np.isnan(funding) & ~(issued_share > 0)
+
+        self.holders = np.full(len(self.IDs), None, dtype=object)
+        self.holders[mainboard] = "1000/6000"
+        self.holders[lower_hold] = "6000"
+
+        self.application_limits = self.prices * offline_purchase_limit
+        self.missing_offline_purchase_limit = ~np.isnan(self.prices) & np.isnan(offline_purchase_limit)
+
+        self.online_limits = price * online_purchase_limit
+        self.missing_online = unpriced | np.isnan(online_purchase_limit)
+
+        self.offline_subscription_dates = self.numeric(IPO_frame["offline_subscription_date"])
+        self.online_subscription_dates = self.numeric(IPO_frame["online_subscription_date"])
+
+    @staticmethod
+    def numeric(column):
+        return pd.to_numeric(column, errors='coerce').to_numpy(dtype=np.float64)
+
+    def positions(self, IPOs):
+        return np.array([self.rows[ipo.ID] for ipo in IPOs], dtype=np.int64)
+
+    @staticmethod
+    def cells(values, positions):
+        ### '%.02f' strings for the report, None where missing
+        values = values[positions]
+        cells = np.full(len(values), None, dtype=object)
+        known = ~np.isnan(values)
+        cells[known] = np.char.mod('%.02f', values[known])
+        return cells
+
+    def missing(self, positions):
+        ### Wind codes with missing inputs among the given rows, one list per raw column
+        report = {
+            "预计募集资金" : self.missing_funding,
+            "新股发行数量" : self.missing_issued_share,
+            "网下申购上限" : self.missing_offline_purchase_limit,
+        }
+        return {column: self.IDs[positions][mask[positions]].tolist() for column, mask in report.items() if mask[positions].any()}
+
+    def capital_at_risk(self, dates):
+        '''
+        Total application caps by subscription date: offline caps of the offline issues and online caps of the online-only issues.
+        One row per date in dates, 0 when nothing subscribes.
+        '''
+        offline = pd.Series(np.where(self.online, np.nan, self.application_limits)).groupby(self.offline_subscription_dates).sum()
+        online = pd.Series(np.where(self.online, self.online_limits, np.nan)).groupby(self.online_subscription_dates).sum()
+        index = [float(date_str(date)) for date in dates]
+        frame = pd.DataFrame({
+            "offline" : offline.reindex(index, fill_value=0.0).to_numpy(),
+            "online"  : online.reindex(index, fill_value=0.0).to_numpy(),
+        }, index = [date_str(date) for date in dates])
+        frame["total"] = frame["offline"] + frame["online"]
+        return frame
+
+
+def read_workbook(file_path):
+    ### the workbook is opened and unzipped once, and only the columns in IPO_dict / subscription_dict are parsed
+    global IPO_dict, subscription_dict, date_fields ### read only, not allow to modify
+    with pd.ExcelFile(file_path) as workbook:
+        IPO_raw = workbook.parse(0, usecols = list(IPO_dict.values()))
+        subscription_raw = workbook.parse(1, usecols = list(subscription_dict.values()))
+        workday_sheet = workbook.parse(2)
+
+    ### dates come as a mix of int, np.float64 and the odd datetime / text cell, align them to nullable ints once
+    for key in date_fields:
+        IPO_raw[IPO_dict[key]] = date_column(IPO_raw[IPO_dict[key]], IPO_raw[IPO_dict["ID"]])
+    return IPO_raw, subscription_raw, workday_sheet
+
+def date_column(column, IDs):
+    ### datetime cells (and NaT) go through date_str first, so that only really unreadable cells are left to coerce
+    if pd.api.types.is_datetime64_any_dtype(column):
+        column = column.dt.strftime("%Y%m%d").astype(object)
+    else:
+        column = column.map(lambda date: date_str(date).strip() if isinstance(date, (datetime, str)) else date, na_action = 'ignore')
+    dates = pd.to_numeric(column, errors = 'coerce')
+    unreadable = dates.isna() & column.notna()
+    if unreadable.any():
+        print(f"{column.name} of {', '.join(map(str, IDs[unreadable]))} can not be read as a date ({', '.join(map(str, column[unreadable].unique()))}). Please check the raw data!")
+    return dates.astype('Int64')
+
+### part of every cache file name, bump it whenever read_workbook changes what it returns so that older caches are not loaded
+workbook_cache_version = 2
+
+def workbook_cache_path(file_path, cache_dir):
+    stat = os.stat(file_path)
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    name = os.path.splitext(os.path.basename(file_path))[0]
+    return os.path.join(cache_dir, f"{name}_v{workbook_cache_version}_{stat.st_size}_{stat.st_mtime_ns}_{sha1.hexdigest()[:16]}.save")
+
+def clear_workbook_cache(cache_dir, file_path = None):
+    if not os.path.isdir(cache_dir):
+        return
+    prefix = None if file_path is None else os.path.splitext(os.path.basename(file_path))[0] + "_"
+    for name in os.listdir(cache_dir):
+        if name.endswith(".save") and (prefix is None or name.startswith(prefix)):
+            try:
+                os.remove(os.path.join(cache_dir, name))
+            except FileNotFoundError: ### cleared by a concurrent run
+                pass
+
+def load_workbook(file_path, cache_dir = None):
+    ### the three parsed sheets are cached by size, mtime and content hash of the workbook, so a re-run skips Excel parsing
+    if cache_dir is None:
+        return read_workbook(file_path)
+    cache_path = workbook_cache_path(file_path, cache_dir)
+    if os.path.exists(cache_path):
+        return joblib.load(cache_path)
+
+    sheets = read_workbook(file_path)
+    os.makedirs(cache_dir, exist_ok = True)
+    clear_workbook_cache(cache_dir, file_path) ### stale copies of the same workbook
+    write_atomic(cache_path, lambda f: joblib.dump(sheets, f)) ### joblib stores the numpy column blocks directly
+    return sheets
+
+
+def lottery_dates(IPO_frame, workday_calendar):
+    '''
+    IPO.cal_lottery_date for a whole ingest_frame of the IPO sheet, without creating the lottery_date of any IPO.
+    The S&T board dates (T+1 of the offline payment) come from one trading_calendar.offset call.
+    '''
+    IDs = IPO_frame["ID"].astype(str)
+    prefixes = IDs.str[:2].to_numpy()
+    offline = IPO_frame["online"].astype(str).str.contains("网下").to_numpy()
+    result = np.full(len(IDs), None, dtype=object)
+
+    sntinnovation = np.flatnonzero((prefixes == "68") & offline)
+    next_days = workday_calendar.offset(IPO_frame["offline_payment_date"].to_numpy(dtype=object)[sntinnovation], 1)
+    result[sntinnovation] = [None if np.isnan(day) else int(day) for day in next_days]
+    result[(prefixes == "30") & offline] = "10%比例限售锁定"
+
+    for row in np.flatnonzero(IDs.isin(list(lottery_date_special_case.keys())).to_numpy()):
+        result[row] = lottery_date_special_case[IDs.iloc[row]]
+    return result
+
+
+class event_index:
+    '''
+    date (date_str) -> event -> IPOs on that date, in sheet order. Built once, so any day is a dictionary lookup
+    and any range of days a bisect over the sorted dates.
+    '''
+    def __init__(self, IPOs=(), lottery_dates=None):
+        self.events = {}
+        self.dates = [] ### sorted, kept up to date by put()
+        if lottery_dates is None:
+            lottery_dates = [_UNSET_] * len(IPOs)
+        for ipo, lottery_date in zip(IPOs, lottery_dates):
+            self.add(ipo, lottery_date)
+
+    def add(self, ipo, lottery_date=_UNSET_):
+        ### lottery_date from lottery_dates() spares the IPO computing its own
+        self.put(ipo.announcement_date, "material_submitting", ipo)
         if ipo.online:
-            if date_str(ipo.online_subscription_date)  == self.today:
-                self.today_IPO["subscription"].append(ipo)
-            if date_str(ipo.online_payment_date) == self.today:
-                self.today_IPO["payment"].append(ipo)
-            if date_str(ipo.online_subscription_date) == self.tomorrow:
-                self.tomorrow_IPO["subscription"].append(ipo)
-            if date_str(ipo.online_payment_date) == self.tomorrow:
-                self.tomorrow_IPO["payment"].append(ipo)
+            self.put(ipo.online_subscription_date, "subscription", ipo)
+            self.put(ipo.online_payment_date, "payment", ipo)
         else:
-            if date_str(ipo.offline_subscription_date)  == self.today:
-                self.today_IPO["subscription"].append(ipo)
-            if date_str(ipo.offline_payment_date) == self.today:
-                self.today_IPO["payment"].append(ipo)
-            if date_str(ipo.offline_subscription_date) == self.tomorrow:
-                self.tomorrow_IPO["subscription"].append(ipo)
-            if date_str(ipo.offline_payment_date) == self.tomorrow:
-                self.tomorrow_IPO["payment"].append(ipo)
+            self.put(ipo.offline_subscription_date, "subscription", ipo)
+            self.put(ipo.offline_payment_date, "payment", ipo)
+            self.put(ipo.inquiry_date, "inquiry", ipo)
+        self.put(ipo.lottery_date if lottery_date is _UNSET_ else lottery_date, "lottery", ipo)
+        self.put(ipo.offering_date, "offering", ipo)
+
+    def put(self, date, event, ipo):
+        date = date_str(date)
+        if date is None:
+            return
+        if date not in self.events and date.isdigit(): ### lottery_date can be a note rather than a date
+            bisect.insort(self.dates, date)
+        self.events.setdefault(date, {}).setdefault(event, []).append(ipo)
+
+    def on(self, date, event):
+        return self.events.get(date_str(date), {}).get(event, [])
+
+    def bucket(self, date, keys):
+        ### the today_IPO / tomorrow_IPO shape: every key present, empty list when nothing happens
+        day = self.events.get(date_str(date), {})
+        return {key: list(day.get(key, [])) for key in keys}
+
+    def between(self, start, end):
+        ### dates in [start, end] that have any event, in order
+        lo = bisect.bisect_left(self.dates, date_str(start))
+        hi = bisect.bisect_right(self.dates, date_str(end))
+        return self.dates[lo:hi]
+
 
-            if date_str(ipo.inquiry_date) == self.today:
-                self.today_IPO["inquiry"].append(ipo)
-            if date_str(ipo.inquiry_date) == self.tomorrow:
-                self.tomorrow_IPO["inquiry"].append(ipo)
+class IPO_calendar():
+    def __init__(self, context):
+        self.context = context
+        self.today = context.today
+        self.tomorrow = context.tomorrow
+        self.IPO_sheet = context.IPO_raw
+        self.subscription_sheet = context.subscription_raw
+        self.workday_calendar = context.workday_calendar
+        self.subscriptions = ingest_frame(self.subscription_sheet, subscription_dict)
+        self.subscription_index = subscription_index_of(self.subscription_sheet) ### row positions are also positions in subscriptions
+
+        '''
+        The data types of raw sheet have not aligned.
+        Some date info is np.float64 type. Therefore, they need to be handle separately
+
+        '''
+        IPO_frame = ingest_frame(self.IPO_sheet, IPO_dict)
+        records = ingest(self.IPO_sheet, IPO_dict)
+        self.entry_status = entry_status([info_dict["ID"] for info_dict in records], self.subscriptions)
+        self.IPOs = [IPO(info_dict, self.context, self.subscriptions, self.subscription_index, status) for info_dict, status in zip(records, self.entry_status)]
+        self.events = event_index(self.IPOs, lottery_dates(IPO_frame, self.workday_calendar))
+        self.pricing = pricing_table(IPO_frame)
+
+        self.today_IPO = self.events.bucket(self.today, ["material_submitting", "inquiry", "subscription", "payment", "lottery", "offering"])
+        self.tomorrow_IPO = self.events.bucket(self.tomorrow, ["inquiry", "subscription", "payment", "lottery", "offering"])
+
+    def active_IPOs(self, buckets=None):
+        ### IPOs with any event in the buckets (today_IPO and tomorrow_IPO by default), each once, in first-seen order
+        return unique_IPOs([self.today_IPO, self.tomorrow_IPO] if buckets is None else buckets)
+
+    def lookahead(self, n):
+        ### today and the next n-1 trading days of the workday sheet, each with a today_IPO shaped bucket
+        dates = [date_str(self.workday_calendar.nth(self.today, i)) for i in range(n)]
+        return [(date, self.events.bucket(date, calendar_dict.keys())) for date in dates]
+
+
+def unique_IPOs(buckets):
+    seen = set() ### Wind codes already yielded
+    for bucket in buckets:
+        for key in bucket.keys():
+            for ipo in bucket[key]:
+                if ipo.ID not in seen:
+                    seen.add(ipo.ID)
+                    yield ipo
+
+def build_calendars(contexts, workers = None):
+    ### one IPO_calendar per run_context, built in parallel threads of the same process
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+        return list(pool.map(IPO_calendar, contexts))
+
+
+@contextmanager
+def render_time(renderer):
+    ### to_html time of every table of a renderer adds up on it, so that a run can report it apart from the stage that built the table
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        yield
+    finally:
+        renderer.wall += time.perf_counter() - wall
+        renderer.cpu += time.process_time() - cpu
+
+class htmltable_renderer:
+    ### HTMLTable backend, every cell carries its own inline style
+    def __init__(self):
+        self.wall = 0.0 ### to_html time, see render_time()
+        self.cpu = 0.0
+
+    def table(self, caption, size = '15px', width = '500px', color = None):
+        return htmltable_table(self, caption, size, width, color)
+
+    def document(self, html_tables):
+        return "".join(html_tables)
+
+class htmltable_table:
+    def __init__(self, renderer, caption, size, width, color):
+        self.renderer = renderer
+        self.table = HTMLTable(caption = caption)
+        caption_style = {
+            'color': '#000000',
+            'font-size': size,
+            'width': width,
+        }
+        if color is not None:
+            caption_style['background-color'] = color
+        self.table.caption.set_style(caption_style)
+        self.has_rows = False
+        self.marks = []
+
+    def append_data_rows(self, rows):
+        self.table.append_data_rows(rows)
+        self.has_rows = True
+
+    def mark(self, row, col, color):
+        self.marks.append((row, col, color))
+
+    def to_html(self):
+        with render_time(self.renderer):
+            return self.render()
+
+    def render(self):
+        if self.has_rows:
+            self.table.set_style({
+              'color': '#000000',
+              'border-collapse': 'collapse',
+              'word-break': 'keep-all',
+              'white-space': 'nowrap',
+              'font-size': '15px',
+              'width': '100%',
+            })
+
+            self.table.set_cell_style({
+              'color': '#000000',
+              'border-color': '#000000',
+              'border-width': '1px',
+              'border-style': 'solid',
+              'padding': '5px',
+            })
 
+            for row, col, color in self.marks:
+                self.table[row][col].set_style({
+                    'background-color' : color,
+                })
+        return self.table.to_html()
+
+
+class css_renderer:
+    ### compact backend, one shared <style> block and class names instead of per-cell inline styles
+    style = (
+        "<style>"
+        "table{color:#000000;border-collapse:collapse;word-break:keep-all;white-space:nowrap;font-size:15px;width:100%}"
+        "caption{color:#000000;font-size:15px;width:500px}"
+        "caption.large{font-size:25px}"
+        "caption.wide{width:100%}"
+        "td{color:#000000;border:1px solid #000000;padding:5px}"
+        ".past{background-color:#C0C0C0}"
+        ".today{background-color:#DC143C}"
+        ".tomorrow{background-color:#CD7F32}"
+        "</style>"
+    )
+    color_classes = {
+        '#C0C0C0' : 'past',
+        '#DC143C' : 'today',
+        '#CD7F32' : 'tomorrow',
+    }
+
+    def __init__(self):
+        self.wall = 0.0 ### to_html time, see render_time()
+        self.cpu = 0.0
+
+    def table(self, caption, size = '15px', width = '500px', color = None):
+        return css_table(self, caption, size, width, color)
+
+    def document(self, html_tables):
+        return '<html><head><meta charset="utf-8">' + self.style + "</head><body>" + "".join(html_tables) + "</body></html>"
+
+class css_table:
+    def __init__(self, renderer, caption, size, width, color):
+        self.renderer = renderer
+        self.rows = []
+        self.marks = {}
+
+        classes = []
+        styles = []
+        if size == '25px':
+            classes.append('large')
+        elif size != '15px':
+            styles.append(f"font-size:{size}")
+        if width == '100%':
+            classes.append('wide')
+        elif width != '500px':
+            styles.append(f"width:{width}")
+        if color in renderer.color_classes:
+            classes.append(renderer.color_classes[color])
+        elif color is not None:
+            styles.append(f"background-color:{color}")
+        attributes = ""
+        if len(classes) > 0:
+            attributes += f' class="{" ".join(classes)}"'
+        if len(styles) > 0:
+            attributes += f' style="{";".join(styles)}"'
+        self.caption = f"<caption{attributes}>{escape(str(caption))}</caption>"
+
+    def append_data_rows(self, rows):
+        self.rows.extend(rows)
+
+    def mark(self, row, col, color):
+        self.marks[(row, col)] = color
+
+    def to_html(self):
+        with render_time(self.renderer):
+            return self.render()
+
+    def render(self):
+        parts = ["<table>", self.caption]
+        for i, row in enumerate(self.rows):
+            parts.append("<tr>")
+            for j, value in enumerate(row):
+                cell = "" if value is None else escape(str(value))
+                if (i, j) not in self.marks:
+                    parts.append(f"<td>{cell}</td>")
+                elif self.marks[(i, j)] in self.renderer.color_classes:
+                    parts.append(f'<td class="{self.renderer.color_classes[self.marks[(i, j)]]}">{cell}</td>')
+                else:
+                    parts.append(f'<td style="background-color:{self.marks[(i, j)]}">{cell}</td>')
+            parts.append("</tr>")
+        parts.append("</table>")
+        return "".join(parts)
 
-        if date_str(ipo.lottery_date) == self.today:
-            self.today_IPO["lottery"].append(ipo)
-        if date_str(ipo.offering_date) == self.today:
-            self.today_IPO["offering"].append(ipo)
 
-        if date_str(ipo.lottery_date) == self.tomorrow:
-            self.tomorrow_IPO["lottery"].append(ipo)
-        if date_str(ipo.offering_date) == self.tomorrow:
-            self.tomorrow_IPO["offering"].append(ipo)
+html_renderers = {
+    "htmltable" : htmltable_renderer, ### inline styles on every cell
+    "css"       : css_renderer, ### one <style> block, a much smaller mail body
+}
 
 
 class excel_writer:
-    def __init__(self, filename):
-        global today, tomorrow ### read only, not allow to modify
-        self.today = date_str(today)
-        self.tomorrow = date_str(tomorrow)
-        self.workbook = xlsxwriter.Workbook(filename) 
+    def __init__(self, filename, context, constant_memory=False, html=None):
+        self.today = context.today
+        self.tomorrow = context.tomorrow
+        self.html = htmltable_renderer() if html is None else html ### css_renderer() for a compact mail body
+        ### constant_memory flushes every row once the next one starts, so rows must be written in order (see write() and merge())
+        self.workbook = xlsxwriter.Workbook(filename, {'constant_memory': constant_memory})
         self.worksheets = {}
+        self.formats = {} ### normalized properties -> Format, each distinct style is created once
+
+    def add_format(self, properties):
+        key = tuple(sorted(properties.items()))
+        if not self.formats.__contains__(key):
+            self.formats[key] = self.workbook.add_format(properties)
+        return self.formats[key]
 
     def add_worksheet(self, sheet_name):
         if self.worksheets.__contains__(sheet_name):
@@ -386,411 +1176,168 @@ class excel_writer:
     def save(self):
         self.workbook.close()
 
-    def generate_IPO_calendar(self, data):
+    def generate_IPO_calendar(self, data, lookahead = None):
         global calendar_dict ### read only, not allow to modify
 
         html_tables = []
 
         calendar = self.add_worksheet("新股日历")
-        title_format = self.workbook.add_format({
+        title_format = self.add_format({
                                                  'bold':True, 
                                                  'align':'left', 
                                                 })
         write(calendar, [0], ["新股日历"], [title_format])
 
-        table = HTMLTable(caption='新股日历')
-        table.caption.set_style({
-            'color': '#000000',
-            'font-size': '25px',
-            'width': '500px',
-        })
+        table = self.html.table('新股日历', '25px', '500px')
 
         html_tables.append(table.to_html())
 
 
-        ### today calendar
-        today_title_format = self.workbook.add_format({
-                                                       'bold':True, 
-                                                       'border':1, 
-                                                       'align':'center', 
-                                                       'fg_color':'#DC143C',
-                                                     })
+        days = None if lookahead is None else data.lookahead(lookahead) ### [(date, bucket), ...] of the report
+        if days is not None:
+            html_tables.append(self.lookahead_calendar(calendar, days))
+            calendar[1] += 1 ### An empty line
+        else:
+            ### today calendar
+            today_title_format = self.add_format({
+                                                           'bold':True, 
+                                                           'border':1, 
+                                                           'align':'center', 
+                                                           'fg_color':'#DC143C',
+                                                         })
 
         
-        table = HTMLTable(caption=self.today)
-        table.caption.set_style({
-            'color': '#000000',
-            'font-size': '15px',
-            'width': '500px',
-            'background-color': '#DC143C',
-        })
+            table = self.html.table(self.today, '15px', '500px', '#DC143C')
         
         
-        calendar[0].merge_range(calendar[1],0,calendar[1],1, self.today, today_title_format)
-
-
-
-        calendar[1] += 1
-        calendar_cell_format = self.workbook.add_format({
-                                                    'bold':True, 
-                                                    'border':1, 
-                                                    'align':'left', 
-                                                  })
+            merge(calendar, 0, 1, self.today, today_title_format)
 
-        table_content = []
-        for key in data.today_IPO.keys():
-            content = ""
-            for ipo in data.today_IPO[key]:
-                content += f" {ipo.IPO_name} "
-            write(calendar,[0,1], [calendar_dict[key], content], [calendar_cell_format for i in range(2)])
-            table_content.append((calendar_dict[key], content))
+            calendar_cell_format = self.add_format({
+                                                        'bold':True, 
+                                                        'border':1, 
+                                                        'align':'left', 
+                                                      })
 
-        table.append_data_rows(table_content)
-        table.set_style({
-          'color': '#000000',
-          'border-collapse': 'collapse',
-          'word-break': 'keep-all',
-          'white-space': 'nowrap',
-          'font-size': '15px',
-          'width': '100%',
-        })
-
-        table.set_cell_style({
-          'color': '#000000',
-          'border-color': '#000000',
-          'border-width': '1px',
-          'border-style': 'solid',
-          'padding': '5px',
-        })
+            table_content = []
+            for key in data.today_IPO.keys():
+                content = ""
+                for ipo in data.today_IPO[key]:
+                    content += f" {ipo.IPO_name} "
+                write(calendar,[0,1], [calendar_dict[key], content], calendar_cell_format)
+                table_content.append((calendar_dict[key], content))
 
+            table.append_data_rows(table_content)
 
-        html_tables.append(table.to_html())
+            html_tables.append(table.to_html())
 
-        calendar[1] += 1 ### An empty line
+            calendar[1] += 1 ### An empty line
 
-        ### tomorrow calendar
-        tomorrow_title_format = self.workbook.add_format({
-                                                       'bold':True, 
-                                                       'border':1, 
-                                                       'align':'center', 
-                                                       'fg_color':'#CD7F32',
-                                                     })
+            ### tomorrow calendar
+            tomorrow_title_format = self.add_format({
+                                                           'bold':True, 
+                                                           'border':1, 
+                                                           'align':'center', 
+                                                           'fg_color':'#CD7F32',
+                                                         })
 
-        calendar[0].merge_range(calendar[1],0,calendar[1],1, self.tomorrow, tomorrow_title_format)
+            merge(calendar, 0, 1, self.tomorrow, tomorrow_title_format)
         
-        table = HTMLTable(caption=self.tomorrow)
-        table.caption.set_style({
-            'color': '#000000',
-            'font-size': '15px',
-            'width': '500px',
-            'background-color': '#CD7F32',
-        })
-
+            table = self.html.table(self.tomorrow, '15px', '500px', '#CD7F32')
 
-        calendar[1] += 1
-        table_content = []
-        for key in data.tomorrow_IPO.keys():
-            content = ""
-            for ipo in data.tomorrow_IPO[key]:
-                content += f" {ipo.IPO_name} "
-            write(calendar,[0,1], [calendar_dict[key], content], [calendar_cell_format for i in range(2)])
-            table_content.append((calendar_dict[key], content))
-
-        table.append_data_rows(table_content)
-        table.set_style({
-          'color': '#000000',
-          'border-collapse': 'collapse',
-          'word-break': 'keep-all',
-          'white-space': 'nowrap',
-          'font-size': '15px',
-          'width': '100%',
-        })
-
-        table.set_cell_style({
-          'border-color': '#000000',
-          'border-width': '1px',
-          'border-style': 'solid',
-          'padding': '5px',
-        })
 
+            table_content = []
+            for key in data.tomorrow_IPO.keys():
+                content = ""
+                for ipo in data.tomorrow_IPO[key]:
+                    content += f" {ipo.IPO_name} "
+                write(calendar,[0,1], [calendar_dict[key], content], calendar_cell_format)
+                table_content.append((calendar_dict[key], content))
 
+            table.append_data_rows(table_content)
 
-        html_tables.append(table.to_html())
+            html_tables.append(table.to_html())
 
-        calendar[1] += 1 ### An empty line
+            calendar[1] += 1 ### An empty line
 
 
         write(calendar,[0], ["详细信息:"], [title_format])
 
-        table = HTMLTable(caption='详细信息')
-        table.caption.set_style({
-            'color': '#000000',
-            'font-size': '15px',
-            'width': '500px',
-        })
+        table = self.html.table('详细信息', '15px', '500px')
 
         html_tables.append(table.to_html())
 
         offline = []
         online = []
-        for key in data.today_IPO.keys():
-            for ipo in data.today_IPO[key]:
-                if not ipo.online and ipo not in offline:
-                    offline.append(ipo)
-                elif ipo.online and ipo not in online:
-                    online.append(ipo)
-        for key in data.tomorrow_IPO.keys():
-            for ipo in data.tomorrow_IPO[key]:
-                if not ipo.online and ipo not in offline:
-                    offline.append(ipo)
-                elif ipo.online and ipo not in online:
-                    online.append(ipo)
+        for ipo in data.active_IPOs(None if days is None else [bucket for _, bucket in days]):
+            if ipo.online:
+                online.append(ipo)
+            else:
+                offline.append(ipo)
 
         global _MAINBOARD_, _SMALLMEDIUMBOARD_, _SNTINNOVATIONBOARD_, _SECONDBOARD_ ### read only, not allow to modify
         global _PAST_, _TODAY_, _TOMORROW_, _FUTURE_ ### read only, not allow to modify
 
         if len(offline) > 0:
-            table = HTMLTable(caption="网下")
-            table.caption.set_style({
-                'color': '#000',
-                'font-size': '15px',
-                'width': '100%',
-            })
+            table = self.html.table("网下", '15px', '100%')
 
             ### offline
             table_content = []
             mark = []
-            titles = ["代码", "简称", "股价测算", "底仓要求", "申报金额上限", "招股公告日", "初步询价起始日", "网下申购起始日", "网下申购缴款日", "网下摇号日", "上市日"]
+            titles = ["代码", "简称", "入围情况", "股价测算", "底仓要求", "申报金额上限", "招股公告日", "初步询价起始日", "网下申购起始日", "网下申购缴款日", "网下摇号日", "上市日"]
             table_content.append(tuple(titles))
 
 
             calendar[0].set_column(0,len(titles),15)
-            write(calendar, range(0,len(titles)), titles, [self.workbook.add_format({'border':1}) for i in range(len(titles))])
+            write(calendar, range(0,len(titles)), titles, self.add_format({'border':1}))
         
-            for ipo in offline:
+            offline_date_fields = ["announcement_date", "inquiry_date", "offline_subscription_date", "offline_payment_date", "lottery_date", "offering_date"]
+            date_codes = {field: classify_dates([getattr(ipo, field) for ipo in offline], self.today, self.tomorrow) for field in offline_date_fields}
+
+            positions = data.pricing.positions(offline)
+            prices = data.pricing.cells(data.pricing.prices, positions)
+            application_limits = data.pricing.cells(data.pricing.application_limits, positions)
+            for column, IDs in data.pricing.missing(positions).items():
+                print(f"{column} of {', '.join(IDs)} missed. 股价测算 / 申报金额上限 can not be calculated. Please check the raw data!")
+
+            for row, ipo in enumerate(offline):
                 contents = []
                 cell_formats = []
 
                 contents.append(ipo.ID)
-                cell_formats.append(self.workbook.add_format({'border':1}))
+                cell_formats.append(self.add_format({'border':1}))
 
                 contents.append(ipo.IPO_name)
-                cell_formats.append(self.workbook.add_format({'border':1}))
+                cell_formats.append(self.add_format({'border':1}))
 
-                price = None
-                if ipo.price is not None:
-                    price = round(ipo.price, 2)
-                   
-                else:
-                    if parse_ID(ipo.ID) == _SNTINNOVATIONBOARD_ or parse_ID(ipo.ID) == _SECONDBOARD_:
-                        pass
-                    elif parse_ID(ipo.ID) == _MAINBOARD_ or parse_ID(ipo.ID) == _SMALLMEDIUMBOARD_:
-                        if ipo.funding is None:
-                            print(f"预计募集资金 of {ipo.ID} missed. The price can not be calculated. Please check the raw data!")
-                            price = None
-                        elif ipo.issued_share is None:
-                            print(f"新股发行数量 of {ipo.ID} missed. The price can not be calculated. Please check the raw data!")
-                            price = None
-                        else:
-                            price = round(ipo.funding / ipo.issued_share, 2)
-                contents.append(price if price is None else '%.02f'%price)
-                cell_formats.append(self.workbook.add_format({'border':1}))
-
-                holder = None
-                if parse_ID(ipo.ID) == _SNTINNOVATIONBOARD_ or parse_ID(ipo.ID) == _SECONDBOARD_ or ipo.ID in lower_hold_special_case:
-                    holder = "6000"
-                elif parse_ID(ipo.ID) == _MAINBOARD_ or parse_ID(ipo.ID) == _SMALLMEDIUMBOARD_:
-                    holder = "1000/6000"
-                contents.append(holder)
-                cell_formats.append(self.workbook.add_format({'border':1}))
-
-                application_limit = None
-                if price is None:
-                    pass
-                else:
-                    if ipo.offline_purchase_limit is None:
-                        print(f"网下申购上限 of {ipo.ID} missed. 申购上限 can not be calculated. Please check the raw data!")
-
-                    else: 
-                        application_limit = price * ipo.offline_purchase_limit
-                contents.append(application_limit if application_limit is None else '%.02f'%application_limit)
-                cell_formats.append(self.workbook.add_format({'border':1}))
-
-                announcement_date = ipo.announcement_date
-                contents.append(announcement_date if announcement_date is None else int(announcement_date))
-                if date_type(announcement_date) == _PAST_:
-                    past_format = self.workbook.add_format({
-                                                           'fg_color':'#C0C0C0', 'border':1,  
-                                                           })
-                    cell_formats.append(past_format)
-                    mark.append(((len(table_content), len(contents)-1), '#C0C0C0') )
-                elif date_type(announcement_date) == _TODAY_:
-                    today_format = self.workbook.add_format({
-                                                           'fg_color':'#DC143C','border':1, 
-                                                           })
-                    cell_formats.append(today_format)
-                    mark.append(((len(table_content), len(contents)-1), '#DC143C') )
-                elif date_type(announcement_date) == _TOMORROW_:
-                    tomorrow_format = self.workbook.add_format({
-                                                           'fg_color':'#CD7F32', 'border':1, 
-                                                           })
-                    cell_formats.append(tomorrow_format)
-                    mark.append(((len(table_content), len(contents)-1), '#CD7F32') )
-                elif date_type(announcement_date) == _FUTURE_:
-                    cell_formats.append(self.workbook.add_format({'border':1}))
-                else: ### -1 
-                    cell_formats.append(self.workbook.add_format({'border':1}))
-
-                inquiry_date = ipo.inquiry_date
-                contents.append(inquiry_date if inquiry_date is None else int(inquiry_date))
-                if date_type(inquiry_date) == _PAST_:
-                    past_format = self.workbook.add_format({
-                                                           'fg_color':'#C0C0C0', 'border':1, 
-                                                           })
-                    cell_formats.append(past_format)
-                    mark.append(((len(table_content), len(contents)-1), '#C0C0C0') )
-                elif date_type(inquiry_date) == _TODAY_:
-                    today_format = self.workbook.add_format({
-                                                           'fg_color':'#DC143C', 'border':1, 
-                                                           })
-                    cell_formats.append(today_format)
-                    mark.append(((len(table_content), len(contents)-1), '#DC143C') )
-                elif date_type(inquiry_date) == _TOMORROW_:
-                    tomorrow_format = self.workbook.add_format({
-                                                           'fg_color':'#CD7F32', 'border':1, 
-                                                           })
-                    cell_formats.append(tomorrow_format)
-                    mark.append(((len(table_content), len(contents)-1), '#CD7F32') )
-                elif date_type(inquiry_date) == _FUTURE_:
-                    cell_formats.append(self.workbook.add_format({'border':1}))
-                else: ### -1 
-                    cell_formats.append(self.workbook.add_format({'border':1}))
-
-                offline_subscription_date = ipo.offline_subscription_date
-                contents.append(offline_subscription_date if offline_subscription_date is None else int(offline_subscription_date))
-                if date_type(offline_subscription_date) == _PAST_:
-                    past_format = self.workbook.add_format({
-                                                           'fg_color':'#C0C0C0','border':1, 
-                                                           })
-                    cell_formats.append(past_format)
-                    mark.append(((len(table_content), len(contents)-1), '#C0C0C0') )
-                elif date_type(offline_subscription_date) == _TODAY_:
-                    today_format = self.workbook.add_format({
-                                                           'fg_color':'#DC143C', 'border':1, 
-                                                           })
-                    cell_formats.append(today_format)
-                    mark.append(((len(table_content), len(contents)-1), '#DC143C') )
-                elif date_type(offline_subscription_date) == _TOMORROW_:
-                    tomorrow_format = self.workbook.add_format({
-                                                           'fg_color':'#CD7F32', 'border':1, 
-                                                           })
-                    cell_formats.append(tomorrow_format)
-                    mark.append(((len(table_content), len(contents)-1), '#CD7F32') )
-                elif date_type(offline_subscription_date) == _FUTURE_:
-                    cell_formats.append(self.workbook.add_format({'border':1}))
-                else: ### -1 
-                    cell_formats.append(self.workbook.add_format({'border':1}))
-
-                offline_payment_date = ipo.offline_payment_date
-                contents.append(offline_payment_date if offline_payment_date is None else int(offline_payment_date))
-                if date_type(offline_payment_date) == _PAST_:
-                    past_format = self.workbook.add_format({
-                                                           'fg_color':'#C0C0C0', 'border':1, 
-                                                           })
-                    cell_formats.append(past_format)
-                    mark.append(((len(table_content), len(contents)-1), '#C0C0C0') )
-                elif date_type(offline_payment_date) == _TODAY_:
-                    today_format = self.workbook.add_format({
-                                                           'fg_color':'#DC143C', 'border':1, 
-                                                           })
-                    cell_formats.append(today_format)
-                    mark.append(((len(table_content), len(contents)-1), '#DC143C') )
-                elif date_type(offline_payment_date) == _TOMORROW_:
-                    tomorrow_format = self.workbook.add_format({
-                                                           'fg_color':'#CD7F32', 'border':1, 
-                                                           })
-                    cell_formats.append(tomorrow_format)
-                    mark.append(((len(table_content), len(contents)-1), '#CD7F32') )
-                elif date_type(offline_payment_date) == _FUTURE_:
-                    cell_formats.append(self.workbook.add_format({'border':1}))
-                else: ### -1 
-                    cell_formats.append(self.workbook.add_format({'border':1}))
-
-                lottery_date = ipo.lottery_date
-                contents.append(lottery_date if lottery_date is None or type(lottery_date) is str else int(lottery_date))
-                if date_type(lottery_date) == _PAST_:
-                    past_format = self.workbook.add_format({
-                                                           'fg_color':'#C0C0C0', 'border':1, 
-                                                           })
-                    cell_formats.append(past_format)
-                    mark.append(((len(table_content), len(contents)-1), '#C0C0C0') )
-                elif date_type(lottery_date) == _TODAY_:
-                    today_format = self.workbook.add_format({
-                                                           'fg_color':'#DC143C', 'border':1, 
-                                                           })
-                    cell_formats.append(today_format)
-                    mark.append(((len(table_content), len(contents)-1), '#DC143C') )
-                elif date_type(lottery_date) == _TOMORROW_:
-                    tomorrow_format = self.workbook.add_format({
-                                                           'fg_color':'#CD7F32', 'border':1, 
-                                                           })
-                    cell_formats.append(tomorrow_format)
-                    mark.append(((len(table_content), len(contents)-1), '#CD7F32') )
-                elif date_type(lottery_date) == _FUTURE_:
-                    cell_formats.append(self.workbook.add_format({'border':1}))
-                else: ### -1 
-                    cell_formats.append(self.workbook.add_format({'border':1}))
-
-                offering_date = ipo.offering_date
-                contents.append(offering_date if offering_date is None else int(offering_date))
-                if date_type(offering_date) == _PAST_:
-                    past_format = self.workbook.add_format({
-                                                           'fg_color':'#C0C0C0', 'border':1, 
-                                                           })
-                    cell_formats.append(past_format)
-                    mark.append(((len(table_content), len(contents)-1), '#C0C0C0') )
-                elif date_type(offering_date) == _TODAY_:
-                    today_format = self.workbook.add_format({
-                                                           'fg_color':'#DC143C', 'border':1, 
-                                                           })
-                    cell_formats.append(today_format)
-                    mark.append(((len(table_content), len(contents)-1), '#DC143C') )
-                elif date_type(offering_date) == _TOMORROW_:
-                    tomorrow_format = self.workbook.add_format({
-                                                           'fg_color':'#CD7F32', 'border':1, 
-                                                           })
-                    cell_formats.append(tomorrow_format)
-                    mark.append(((len(table_content), len(contents)-1), '#CD7F32') )
-                elif date_type(offering_date) == _FUTURE_:
-                    cell_formats.append(self.workbook.add_format({'border':1}))
-                else: ### -1 
-                    cell_formats.append(self.workbook.add_format({'border':1}))
+                contents.append(entry_labels.get(ipo.entry_status)) ### known for every IPO, not only those subscribing today or tomorrow
+                cell_formats.append(self.add_format({'border':1}))
+
+                contents.append(prices[row])
+                cell_formats.append(self.add_format({'border':1}))
+
+                contents.append(data.pricing.holders[positions[row]])
+                cell_formats.append(self.add_format({'border':1}))
+
+                contents.append(application_limits[row])
+                cell_formats.append(self.add_format({'border':1}))
+
+                for field in offline_date_fields:
+                    date = getattr(ipo, field)
+                    contents.append(date if date is None or type(date) is str else int(date))
+                    code = int(date_codes[field][row])
+                    if code in date_colors:
+                        cell_formats.append(self.add_format({'fg_color':date_colors[code], 'border':1}))
+                        mark.append(((len(table_content), len(contents)-1), date_colors[code]) )
+                    else: ### future or -1
+                        cell_formats.append(self.add_format({'border':1}))
 
                 write(calendar, range(0,len(titles)), contents, cell_formats)
                 table_content.append(contents)
 
             table.append_data_rows(table_content)
 
-            table.set_style({
-              'color': '#000000',
-              'border-collapse': 'collapse',
-              'word-break': 'keep-all',
-              'white-space': 'nowrap',
-              'font-size': '15px',
-              'width': '100%',
-            })
-
-            table.set_cell_style({
-              'border-color': '#000000',
-              'border-width': '1px',
-              'border-style': 'solid',
-              'padding': '5px',
-            })
-
             for cell in mark:
-                table[cell[0][0]][cell[0][1]].set_style({
-                    'background-color' : cell[1],
-                })
+                table.mark(cell[0][0], cell[0][1], cell[1])
 
             html_tables.append(table.to_html())
 
@@ -798,197 +1345,139 @@ class excel_writer:
             calendar[1] += 1 ### An empty line
 
         if len(online) > 0:
-            table = HTMLTable(caption="网上")
-            table.caption.set_style({
-                'color': '#000',
-                'font-size': '15px',
-                'width': '100%',
-            })
+            table = self.html.table("网上", '15px', '100%')
 
             ### online
             table_content = []
             mark = []
             titles = ["代码", "简称", "股价", "网上申购上限(股)", "网上申购资金上限", "招股公告日", "网上申购起始日", "网上申购缴款日", "上市日"]
-            write(calendar, range(0,len(titles)), titles, [self.workbook.add_format({'border':1}) for i in range(len(titles))])
+            write(calendar, range(0,len(titles)), titles, self.add_format({'border':1}))
             table_content.append(tuple(titles))
 
-            for ipo in online:
+            online_date_fields = ["announcement_date", "online_subscription_date", "online_payment_date", "offering_date"]
+            date_codes = {field: classify_dates([getattr(ipo, field) for ipo in online], self.today, self.tomorrow) for field in online_date_fields}
+            positions = data.pricing.positions(online)
+
+            for row, ipo in enumerate(online):
                 contents = []
                 cell_formats = []
 
                 contents.append(ipo.ID)
-                cell_formats.append(self.workbook.add_format({'border':1}))
+                cell_formats.append(self.add_format({'border':1}))
 
                 contents.append(ipo.IPO_name)
-                cell_formats.append(self.workbook.add_format({'border':1}))
+                cell_formats.append(self.add_format({'border':1}))
 
                 contents.append(ipo.price)
-                cell_formats.append(self.workbook.add_format({'border':1}))
+                cell_formats.append(self.add_format({'border':1}))
 
                 contents.append(ipo.online_purchase_limit)
-                cell_formats.append(self.workbook.add_format({'border':1}))
+                cell_formats.append(self.add_format({'border':1}))
 
-                if ipo.price is not None and ipo.online_purchase_limit is not None:
-                    contents.append(ipo.price * ipo.online_purchase_limit)
-                else:
-                    contents.append(self.workbook.add_format({'border':1}))
-                cell_formats.append(self.workbook.add_format({'border':1}))
-
-                announcement_date = ipo.announcement_date
-                contents.append(announcement_date if announcement_date is None else int(announcement_date))
-                if date_type(announcement_date) == _PAST_:
-                    past_format = self.workbook.add_format({
-                                                           'fg_color':'#C0C0C0', 'border':1, 
-                                                           })
-                    cell_formats.append(past_format)
-                    mark.append(((len(table_content), len(contents)-1), '#C0C0C0') )
-                elif date_type(announcement_date) == _TODAY_:
-                    today_format = self.workbook.add_format({
-                                                           'fg_color':'#DC143C', 'border':1, 
-                                                           })
-                    cell_formats.append(today_format)
-                    mark.append(((len(table_content), len(contents)-1), '#DC143C') )
-                elif date_type(announcement_date) == _TOMORROW_:
-                    tomorrow_format = self.workbook.add_format({
-                                                           'fg_color':'#CD7F32', 'border':1, 
-                                                           })
-                    cell_formats.append(tomorrow_format)
-                    mark.append(((len(table_content), len(contents)-1), '#CD7F32') )
-                elif date_type(announcement_date) == _FUTURE_:
-                    cell_formats.append(self.workbook.add_format({'border':1}))
-                else: ### -1 
-                    cell_formats.append(self.workbook.add_format({'border':1}))
-
-                online_subscription_date = ipo.online_subscription_date
-                contents.append(online_subscription_date if online_subscription_date is None else int(online_subscription_date))
-                if date_type(online_subscription_date) == _PAST_:
-                    past_format = self.workbook.add_format({
-                                                           'fg_color':'#C0C0C0', 'border':1, 
-                                                           })
-                    cell_formats.append(past_format)
-                    mark.append(((len(table_content), len(contents)-1), '#C0C0C0') )
-                elif date_type(online_subscription_date) == _TODAY_:
-                    today_format = self.workbook.add_format({
-                                                           'fg_color':'#DC143C', 'border':1, 
-                                                           })
-                    cell_formats.append(today_format)
-                    mark.append(((len(table_content), len(contents)-1), '#DC143C') )
-                elif date_type(online_subscription_date) == _TOMORROW_:
-                    tomorrow_format = self.workbook.add_format({
-                                                           'fg_color':'#CD7F32', 'border':1, 
-                                                           })
-                    cell_formats.append(tomorrow_format)
-                    mark.append(((len(table_content), len(contents)-1), '#CD7F32') )
-                elif date_type(online_subscription_date) == _FUTURE_:
-                    cell_formats.append(self.workbook.add_format({'border':1}))
-                else: ### -1 
-                    cell_formats.append(self.workbook.add_format({'border':1}))
-
-                online_payment_date = ipo.online_payment_date
-                contents.append(online_payment_date if online_payment_date is None else int(online_payment_date))
-                if date_type(online_payment_date) == _PAST_:
-                    past_format = self.workbook.add_format({
-                                                           'fg_color':'#C0C0C0', 'border':1, 
-                                                           })
-                    cell_formats.append(past_format)
-                    mark.append(((len(table_content), len(contents)-1), '#C0C0C0') )
-                elif date_type(online_payment_date) == _TODAY_:
-                    today_format = self.workbook.add_format({
-                                                           'fg_color':'#DC143C', 'border':1, 
-                                                           })
-                    cell_formats.append(today_format)
-                    mark.append(((len(table_content), len(contents)-1), '#DC143C') )
-                elif date_type(online_payment_date) == _TOMORROW_:
-                    tomorrow_format = self.workbook.add_format({
-                                                           'fg_color':'#CD7F32', 'border':1, 
-                                                           })
-                    cell_formats.append(tomorrow_format)
-                    mark.append(((len(table_content), len(contents)-1), '#CD7F32') )
-                elif date_type(online_payment_date) == _FUTURE_:
-                    cell_formats.append(self.workbook.add_format({'border':1}))
-                else: ### -1 
-                    cell_formats.append(self.workbook.add_format({'border':1}))
-
-
-                offering_date = ipo.offering_date
-                contents.append(offering_date if offering_date is None else int(offering_date))
-                if date_type(offering_date) == _PAST_:
-                    past_format = self.workbook.add_format({
-                                                           'fg_color':'#C0C0C0', 'border':1, 
-                                                           })
-                    cell_formats.append(past_format)
-                    mark.append(((len(table_content), len(contents)-1), '#C0C0C0') )
-                elif date_type(offering_date) == _TODAY_:
-                    today_format = self.workbook.add_format({
-                                                           'fg_color':'#DC143C', 'border':1, 
-                                                           })
-                    cell_formats.append(today_format)
-                    mark.append(((len(table_content), len(contents)-1), '#DC143C') )
-                elif date_type(offering_date) == _TOMORROW_:
-                    tomorrow_format = self.workbook.add_format({
-                                                           'fg_color':'#CD7F32', 'border':1, 
-                                                           })
-                    cell_formats.append(tomorrow_format)
-                    mark.append(((len(table_content), len(contents)-1), '#CD7F32') )
-                elif date_type(offering_date) == _FUTURE_:
-                    cell_formats.append(self.workbook.add_format({'border':1}))
-                else: ### -1 
-                    cell_formats.append(self.workbook.add_format({'border':1}))
+                contents.append(None if data.pricing.missing_online[positions[row]] else float(data.pricing.online_limits[positions[row]]))
+                cell_formats.append(self.add_format({'border':1}))
+
+                for field in online_date_fields:
+                    date = getattr(ipo, field)
+                    contents.append(date if date is None or type(date) is str else int(date))
+                    code = int(date_codes[field][row])
+                    if code in date_colors:
+                        cell_formats.append(self.add_format({'fg_color':date_colors[code], 'border':1}))
+                        mark.append(((len(table_content), len(contents)-1), date_colors[code]) )
+                    else: ### future or -1
+                        cell_formats.append(self.add_format({'border':1}))
 
                 write(calendar, range(0,len(titles)), contents, cell_formats)
                 table_content.append(contents)
 
             table.append_data_rows(table_content)
 
-            table.set_style({
-              'color': '#000000',
-              'border-collapse': 'collapse',
-              'word-break': 'keep-all',
-              'white-space': 'nowrap',
-              'font-size': '15px',
-              'width': '100%',
-            })
-
-            table.set_cell_style({
-              'border-color': '#000000',
-              'border-width': '1px',
-              'border-style': 'solid',
-              'padding': '5px',
-            })
-
             for cell in mark:
-                table[cell[0][0]][cell[0][1]].set_style({
-                    'background-color' : cell[1],
-                })
+                table.mark(cell[0][0], cell[0][1], cell[1])
 
             html_tables.append(table.to_html())
 
+            calendar[1] += 1 ### An empty line
+
+        ### capital tied up by the application caps of the issues subscribing on each day of the report
+        if days is not None:
+            dates = [date for date, _ in days]
+        else:
+            dates = [self.today, self.tomorrow]
+        capital = data.pricing.capital_at_risk(dates)
+
+        table = self.html.table("申购资金需求", '15px', '500px')
+        titles = ["日期", "网下申报金额上限", "网上申购资金上限", "合计"]
+        write(calendar, range(0,len(titles)), titles, self.add_format({'border':1}))
+        table_content = [tuple(titles)]
+        for date, offline_capital, online_capital, total in capital.itertuples(name=None):
+            contents = [date, '%.02f'%offline_capital, '%.02f'%online_capital, '%.02f'%total]
+            write(calendar, range(0,len(titles)), contents, self.add_format({'border':1}))
+            table_content.append(contents)
+        table.append_data_rows(table_content)
+        html_tables.append(table.to_html())
+
         return html_tables
 
+    def lookahead_calendar(self, calendar, days):
+        ### one column per trading day (data.lookahead()), one row per event, today and tomorrow headed in their usual colors
+
+        header_format = self.add_format({
+                                                'bold':True, 
+                                                'border':1, 
+                                                'align':'center', 
+                                              })
+        calendar_cell_format = self.add_format({
+                                                    'bold':True, 
+                                                    'border':1, 
+                                                    'align':'left', 
+                                                  })
+        header_formats = [header_format]
+        for date, _ in days:
+            if date == self.today:
+                header_formats.append(self.add_format({'bold':True, 'border':1, 'align':'center', 'fg_color':date_colors[_TODAY_]}))
+            elif date == self.tomorrow:
+                header_formats.append(self.add_format({'bold':True, 'border':1, 'align':'center', 'fg_color':date_colors[_TOMORROW_]}))
+            else:
+                header_formats.append(header_format)
+
+        table = self.html.table(f"未来{len(days)}个交易日", '15px', '100%')
+
+        header = [""] + [date for date, _ in days]
+        write(calendar, list(range(len(header))), header, header_formats)
+        table_content = [tuple(header)]
+        for col, (date, _) in enumerate(days, start = 1):
+            if date == self.today:
+                table.mark(0, col, date_colors[_TODAY_])
+            elif date == self.tomorrow:
+                table.mark(0, col, date_colors[_TOMORROW_])
+
+        for key in calendar_dict.keys():
+            row = [calendar_dict[key]] + ["".join(f" {ipo.IPO_name} " for ipo in bucket[key]) for _, bucket in days]
+            write(calendar, list(range(len(row))), row, calendar_cell_format)
+            table_content.append(tuple(row))
+
+        table.append_data_rows(table_content)
+        return table.to_html()
+
     def today_offering(self, data):
 
         html_tables = []
 
-        table = HTMLTable(caption='今日上市')
-        table.caption.set_style({
-            'color': '#000000',
-            'font-size': '25px',
-            'width': '500px',
-            'background-color':'#DC143C',
-        })
+        table = self.html.table('今日上市', '25px', '500px', '#DC143C')
 
         html_tables.append(table.to_html())
 
         calendar = self.add_worksheet("今日上市")
 
-        title_format = self.workbook.add_format({
+        title_format = self.add_format({
                                                  'bold':True, 
                                                  'align':'center', 
                                                 })
 
         write(calendar, [0], ["今日上市"], [title_format])
 
-        table_cell_format = self.workbook.add_format({
+        table_cell_format = self.add_format({
                                                       'border':1, 
                                                       'align':'center', 
                                                     })
@@ -1001,73 +1490,39 @@ class excel_writer:
 
         if len(ipos) == 0:
             write(calendar, [0], ["无"], [title_format])
-            table = HTMLTable(caption='无')
-            table.caption.set_style({
-                'color': '#000000',
-                'font-size': '15px',
-                'width': '100%',
-            })
+            table = self.html.table('无', '15px', '100%')
 
             html_tables.append(table.to_html())
 
 
         for ipo in ipos:
-            table = HTMLTable(caption = ipo.ID + "   " + ipo.IPO_name)
-            table.caption.set_style({
-                'color': '#000000',
-                'font-size': '25px',
-                'width': '100%',
-            })
+            table = self.html.table(ipo.ID + "   " + ipo.IPO_name, '25px', '100%')
 
             
 
             write(calendar, [0], [ipo.ID + "   " + ipo.IPO_name], [title_format])
-            write(calendar, range(0,len(titles)), titles, [table_cell_format for i in range(len(titles))])
+            write(calendar, range(0,len(titles)), titles, table_cell_format)
             
             table_content = []
             table_content.append(tuple(titles))
 
-            for allotment in ipo.allotment_subjects:
-                if not allotment.valid:
-                    continue
-                if parse_ID(ipo.ID) == _SECONDBOARD_:
-                    contents = [allotment.name, '%.02f'%(allotment.valid_subscription_amount*0.1) if int(allotment.lockup_period) == 6 else '%.02f'%(allotment.valid_subscription_amount*0.9), '%.02f'%allotment.allotment_amount]
-                else:
-                    contents = [allotment.name, '%.02f'%allotment.valid_subscription_amount, '%.02f'%allotment.allotment_amount]
-
-                lockup_period = allotment.lockup_period
-                if lockup_period is not None and int(lockup_period) == 6:
-                    contents.append(6)
-                elif lockup_period is not None and int(lockup_period) == 0:
-                    contents.append("-")
-                else:
-                    contents.append(None)
-
-
-
+            allotments = ipo.allotment_subjects.valid_only()
+            if ipo.board_type == _SECONDBOARD_:
+                valid_subscription_amounts = allotments.lockup_split_amounts()
+            else:
+                valid_subscription_amounts = allotments.valid_subscription_amounts
+            columns = [
+                allotments.names,
+                np.char.mod('%.02f', valid_subscription_amounts),
+                np.char.mod('%.02f', allotments.allotment_amounts),
+                allotments.lockup_labels(),
+            ]
 
-                write(calendar, range(0,len(titles)), contents, [table_cell_format for i in range(len(titles))])
-
-                table_content.append(contents)
+            write_rows(calendar, columns, table_cell_format)
+            table_content.extend(zip(*columns))
 
             table.append_data_rows(table_content)
 
-            table.set_style({
-              'color': '#000000',
-              'border-collapse': 'collapse',
-              'word-break': 'keep-all',
-              'white-space': 'nowrap',
-              'font-size': '15px',
-              'width': '100%',
-            })
-
-            table.set_cell_style({
-              'border-color': '#000000',
-              'border-width': '1px',
-              'border-style': 'solid',
-              'padding': '5px',
-            })
-
             html_tables.append(table.to_html())
 
             calendar[1] += 1 ### An empty line
@@ -1080,26 +1535,20 @@ class excel_writer:
 
         html_tables = []
 
-        table = HTMLTable(caption='今日申购')
-        table.caption.set_style({
-            'color': '#000000',
-            'font-size': '25px',
-            'width': '500px',
-            'background-color':'#DC143C',
-        })
+        table = self.html.table('今日申购', '25px', '500px', '#DC143C')
 
         html_tables.append(table.to_html())
 
         calendar = self.add_worksheet("今日申购")
 
-        title_format = self.workbook.add_format({
+        title_format = self.add_format({
                                                  'bold':True, 
                                                  'align':'center', 
                                                 })
 
         write(calendar, [0], ["今日申购"], [title_format])
 
-        table_cell_format = self.workbook.add_format({
+        table_cell_format = self.add_format({
                                                       'border':1, 
                                                       'align':'center', 
                                                     })
@@ -1112,12 +1561,7 @@ class excel_writer:
 
         if len(ipos) == 0:
             write(calendar, [0], ["无"], [title_format])
-            table = HTMLTable(caption='无')
-            table.caption.set_style({
-                'color': '#000000',
-                'font-size': '15px',
-                'width': '100%',
-            })
+            table = self.html.table('无', '15px', '100%')
 
             html_tables.append(table.to_html())
 
@@ -1125,46 +1569,29 @@ class excel_writer:
         for ipo in ipos:
             if ipo.entry == 2:
                 continue
-            table = HTMLTable(caption = ipo.ID + "   " + ipo.IPO_name)
-            table.caption.set_style({
-                'color': '#000000',
-                'font-size': '25px',
-                'width': '100%',
-            })
+            table = self.html.table(ipo.ID + "   " + ipo.IPO_name, '25px', '100%')
 
 
 
             write(calendar, [0], [ipo.ID + "   " + ipo.IPO_name], [title_format])
-            write(calendar, range(0,len(titles)), titles, [table_cell_format for i in range(len(titles))])
+            write(calendar, range(0,len(titles)), titles, table_cell_format)
 
 
             table_content = []
             table_content.append(tuple(titles))
             
-            for allotment in ipo.allotment_subjects:
-                if not allotment.valid:
-                    continue
+            allotments = ipo.allotment_subjects.valid_only()
+            columns = [
+                allotments.names,
+                allotments.quotes,
+                ["是"] * len(allotments), ### only valid quotes are listed
+                allotments.subscription_amounts,
+            ]
 
-                contents = [allotment.name, allotment.quote, "是" if allotment.valid else "否", allotment.subscription_amount]
-                write(calendar, range(0,len(titles)), contents, [table_cell_format for i in range(len(titles))])
-                table_content.append(contents)
+            write_rows(calendar, columns, table_cell_format)
+            table_content.extend(zip(*columns))
 
             table.append_data_rows(table_content)
-            table.set_style({
-              'color': '#000000',
-              'border-collapse': 'collapse',
-              'word-break': 'keep-all',
-              'white-space': 'nowrap',
-              'font-size': '15px',
-              'width': '100%',
-            })
-
-            table.set_cell_style({
-              'border-color': '#000000',
-              'border-width': '1px',
-              'border-style': 'solid',
-              'padding': '5px',
-            })
 
             html_tables.append(table.to_html())
 
@@ -1180,27 +1607,21 @@ class excel_writer:
 
         html_tables = []
 
-        table = HTMLTable(caption='明日申购')
-        table.caption.set_style({
-            'color': '#000000',
-            'font-size': '25px',
-            'width': '500px',
-            'background-color':'#CD7F32'
-        })
+        table = self.html.table('明日申购', '25px', '500px', '#CD7F32')
 
         html_tables.append(table.to_html())
 
 
         calendar = self.add_worksheet("明日申购")
 
-        title_format = self.workbook.add_format({
+        title_format = self.add_format({
                                                  'bold':True, 
                                                  'align':'center', 
                                                 })
 
         write(calendar, [0], ["明日申购"], [title_format])
 
-        table_cell_format = self.workbook.add_format({
+        table_cell_format = self.add_format({
                                                       'border':1, 
                                                       'align':'center', 
                                                     })
@@ -1211,12 +1632,7 @@ class excel_writer:
 
         if len(ipos) == 0:
             write(calendar, [0], ["无"], [title_format])
-            table = HTMLTable(caption='无')
-            table.caption.set_style({
-                'color': '#000000',
-                'font-size': '15px',
-                'width': '100%',
-            })
+            table = self.html.table('无', '15px', '100%')
 
             html_tables.append(table.to_html())
 
@@ -1224,43 +1640,26 @@ class excel_writer:
         for ipo in ipos:
             if ipo.entry == 2:
                 continue
-            table = HTMLTable(caption = ipo.ID + "   " + ipo.IPO_name)
-            table.caption.set_style({
-                'color': '#000000',
-                'font-size': '25px',
-                'width': '100%',
-            })
+            table = self.html.table(ipo.ID + "   " + ipo.IPO_name, '25px', '100%')
 
             write(calendar, [0], [ipo.ID + "   " + ipo.IPO_name], [title_format])
-            write(calendar, range(0,len(titles)), titles, [table_cell_format for i in range(len(titles))])
+            write(calendar, range(0,len(titles)), titles, table_cell_format)
             
             table_content = []
             table_content.append(tuple(titles))
 
-            for allotment in ipo.allotment_subjects:
-                if not allotment.valid:
-                    continue
+            allotments = ipo.allotment_subjects.valid_only()
+            columns = [
+                allotments.names,
+                allotments.quotes,
+                ["是"] * len(allotments), ### only valid quotes are listed
+                allotments.subscription_amounts,
+            ]
 
-                contents = [allotment.name, allotment.quote, "是" if allotment.valid else "否", allotment.subscription_amount]
-                write(calendar, range(0,len(titles)), contents, [table_cell_format for i in range(len(titles))])
-                table_content.append(contents)
+            write_rows(calendar, columns, table_cell_format)
+            table_content.extend(zip(*columns))
 
             table.append_data_rows(table_content)
-            table.set_style({
-              'color': '#000000',
-              'border-collapse': 'collapse',
-              'word-break': 'keep-all',
-              'white-space': 'nowrap',
-              'font-size': '15px',
-              'width': '100%',
-            })
-
-            table.set_cell_style({
-              'border-color': '#000000',
-              'border-width': '1px',
-              'border-style': 'solid',
-              'padding': '5px',
-            })
 
             html_tables.append(table.to_html())
 
@@ -1270,14 +1669,55 @@ class excel_writer:
         return html_tables
 
 def write(worksheet, cols, contents, cell_formats = None):
-    if cell_formats is None:
-        for i in range(len(cols)):
-            worksheet[0].write(worksheet[1], cols[i], contents[i])
+    if cell_formats is None or not isinstance(cell_formats, list): ### one format for the whole row, cols are contiguous
+        worksheet[0].write_row(worksheet[1], cols[0], contents, cell_formats)
     else:
         for i in range(len(cols)):
             worksheet[0].write(worksheet[1], cols[i], contents[i], cell_formats[i])
     worksheet[1] += 1
 
+def write_rows(worksheet, block, cell_format = None, first_col = 0):
+    '''
+    Write a 2-D block one whole row at a time from the cursor.
+    block is a pandas DataFrame, a 2-D numpy array, or a list of columns (one sequence per column).
+    '''
+    if hasattr(block, "itertuples"):
+        rows = block.itertuples(index=False, name=None)
+    elif isinstance(block, np.ndarray):
+        rows = block.tolist()
+    else:
+        rows = zip(*block)
+    for row in rows:
+        worksheet[0].write_row(worksheet[1], first_col, row, cell_format)
+        worksheet[1] += 1
+
+
+def merge(worksheet, first_col, last_col, content, cell_format = None):
+    ### merged title on the current row, written in row order so constant_memory mode keeps it
+    worksheet[0].merge_range(worksheet[1], first_col, worksheet[1], last_col, content, cell_format)
+    worksheet[1] += 1
+
+
+def mail_message(address, mail_list, contents, attachment = None, today = None):
+    if today is None: ### the day of the call, not of the import, for a long-lived spool or pool
+        today = datetime.today()
+    msg = MIMEMultipart()
+    msg['From'] = formataddr(["LZY", address])
+    msg['To'] = formataddr(["Test",",".join(mail_list)])
+    msg['Subject'] = date_str(today)+"_IPO_Info"
+
+    if type(contents) is list:
+        for content in contents:
+            msg.attach(content)
+    else:
+        msg.attach(contents)
+
+    if attachment is not None:
+        with open(attachment, 'rb') as f:
+            file = MIMEApplication(f.read())
+        file.add_header("Content-Disposition", "attachment", filename = os.path.basename(attachment))
+        msg.attach(file)
+    return msg
 
 
 class mail:
@@ -1293,23 +1733,9 @@ class mail:
         self.SMTP_server.login(self.address, self.authorization_code)
 
 
-    def send(self, mail_list, contents, attachment = None, today = date_str(datetime.today())):
-        msg = MIMEMultipart()
-        msg['From'] = formataddr(["LZY", self.address])
-        msg['To'] = formataddr(["Test",",".join(mail_list)])
+    def send(self, mail_list, contents, attachment = None, today = None):
+        msg = mail_message(self.address, mail_list, contents, attachment, today)
         print(",".join(mail_list))
-        msg['Subject'] = date_str(today)+"_IPO_Info"
-
-        if type(contents) is list:
-            for content in contents:
-                msg.attach(content)
-        else:
-            msg.attach(contents)
-
-        if attachment is not None:
-            file = MIMEApplication(open(attachment, 'rb').read())
-            file.add_header("Content-Disposition", "attachment", filename = attachment)
-            msg.attach(file)
 
         try:
             self.SMTP_server.sendmail(self.address, mail_list, msg.as_string())
@@ -1324,45 +1750,384 @@ class mail:
 
 
 
+class mail_pool:
+    ### keeps up to size authenticated connections open and delivers batches over them in parallel
+    def __init__(self, address, authorization_code, server, port, size = 4, retries = 2):
+        self.address = address
+        self.authorization_code = authorization_code
+        self.server = server
+        self.port = port
+        self.size = size
+        self.retries = retries
+        self.idle = queue.LifoQueue() ### the most recently used connection is the least likely to have timed out
+
+    def connect(self):
+        SMTP_server = smtplib.SMTP()
+        SMTP_server.connect(self.server, self.port)
+        if self.authorization_code is not None:
+            SMTP_server.login(self.address, self.authorization_code)
+        return SMTP_server
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            return self.connect()
+
+    def release(self, SMTP_server):
+        if self.idle.qsize() < self.size:
+            self.idle.put(SMTP_server)
+        else:
+            self.discard(SMTP_server)
+
+    def discard(self, SMTP_server):
+        try:
+            SMTP_server.quit()
+        except Exception:
+            SMTP_server.close()
+
+    def deliver(self, mail_list, msg):
+        for attempt in range(self.retries + 1):
+            try:
+                SMTP_server = self.acquire()
+            except (smtplib.SMTPException, OSError) as e:
+                error = e
+                continue
+            try:
+                SMTP_server.sendmail(self.address, mail_list, msg.as_string())
+            except (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError) as e: ### broken connection, reconnect and retry
+                SMTP_server.close()
+                error = e
+                continue
+            except smtplib.SMTPException as e: ### the server refused the message, the connection is still usable
+                self.release(SMTP_server)
+                print ('Failed--' + str(e))
+                return False
+            self.release(SMTP_server)
+            return True
+        print ('Failed--' + str(error))
+        return False
+
+    def send_batch(self, messages):
+        ### messages: [(mail_list, msg), ...], returns one True / False per message
+        with ThreadPoolExecutor(max_workers = self.size) as pool:
+            return list(pool.map(lambda message: self.deliver(*message), messages))
+
+    def close(self):
+        while not self.idle.empty():
+            self.discard(self.idle.get_nowait())
+
+
+class mail_spool:
+    '''
+    Outbound messages are written to path as <ID>.eml plus an <ID>.json envelope (the envelope is written last and marks the message as queued).
+    A background thread drains the spool through a mail_pool, retrying failed messages with exponential backoff.
+    '''
+    def __init__(self, path, pool, base_delay = 30, max_delay = 3600, max_attempts = 10, poll = 5):
+        self.path = path
+        self.failed_path = os.path.join(path, "failed") ### messages that ran out of attempts
+        os.makedirs(self.failed_path, exist_ok = True)
+        self.pool = pool
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.poll = poll
+
+        self.delivered = 0
+        self.failed_attempts = 0
+        self.given_up = 0
+        self.latency_sum = 0.0 ### seconds from put() to delivery, running totals so a long-lived worker stays small
+        self.latency_max = None
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.draining = False
+        self.worker = None
+
+    def write_envelope(self, ID, envelope):
+        write_atomic(os.path.join(self.path, ID + ".json"), lambda f: f.write(json.dumps(envelope, ensure_ascii=False).encode('utf-8')))
+
+    def put(self, mail_list, msg):
+        ID = f"{time.time_ns()}_{uuid.uuid4().hex[:8]}"
+        write_atomic(os.path.join(self.path, ID + ".eml"), lambda f: f.write(msg.as_bytes()))
+        self.write_envelope(ID, {"mail_list": list(mail_list), "queued": time.time(), "attempts": 0, "next_attempt": 0})
+        self.wakeup.set()
+        return ID
+
+    def queued(self):
+        return sorted(name[:-5] for name in os.listdir(self.path) if name.endswith(".json"))
+
+    def queue_depth(self):
+        return len(self.queued())
+
+    def drain_once(self):
+        for ID in self.queued():
+            if self.stopping.is_set() and not self.draining:
+                return
+            envelope_path = os.path.join(self.path, ID + ".json")
+            message_path = os.path.join(self.path, ID + ".eml")
+            with open(envelope_path, 'r', encoding='utf-8') as f:
+                envelope = json.load(f)
+            if envelope["next_attempt"] > time.time():
+                continue
+
+            with open(message_path, 'rb') as f:
+                msg = message_from_bytes(f.read())
+            if self.pool.deliver(envelope["mail_list"], msg):
+                os.remove(envelope_path)
+                os.remove(message_path)
+                with self.lock:
+                    latency = time.time() - envelope["queued"]
+                    self.delivered += 1
+                    self.latency_sum += latency
+                    self.latency_max = latency if self.latency_max is None else max(self.latency_max, latency)
+                continue
+
+            envelope["attempts"] += 1
+            with self.lock:
+                self.failed_attempts += 1
+            if envelope["attempts"] >= self.max_attempts:
+                os.replace(message_path, os.path.join(self.failed_path, ID + ".eml"))
+                os.replace(envelope_path, os.path.join(self.failed_path, ID + ".json"))
+                with self.lock:
+                    self.given_up += 1
+                continue
+            envelope["next_attempt"] = time.time() + min(self.max_delay, self.base_delay * 2 ** (envelope["attempts"] - 1))
+            self.write_envelope(ID, envelope)
+
+    def run(self):
+        while not self.stopping.is_set():
+            self.wakeup.clear()
+            self.drain_once()
+            self.wakeup.wait(self.poll)
+        if self.draining:
+            self.drain_once()
+
+    def start(self):
+        self.stopping.clear()
+        self.draining = False
+        self.worker = threading.Thread(target = self.run, daemon = True)
+        self.worker.start()
+
+    def stop(self, drain = False):
+        ### drain: make one last delivery pass over everything that is due before the worker exits
+        self.draining = drain
+        self.stopping.set()
+        self.wakeup.set()
+        if self.worker is not None:
+            self.worker.join()
+            self.worker = None
+
+    def stats(self):
+        with self.lock:
+            return {
+                "queue_depth"     : self.queue_depth(),
+                "delivered"       : self.delivered,
+                "failed_attempts" : self.failed_attempts,
+                "given_up"        : self.given_up,
+                "latency_mean"    : self.latency_sum / self.delivered if self.delivered > 0 else None,
+                "latency_max"     : self.latency_max,
+            }
+
+
+class run_profiler:
+    ### wall-clock, CPU and tracemalloc peak of every stage of a run, dumped as a JSON report
+    def __init__(self, trace_memory = False, profile_stage = None, profile_path = None):
+        self.trace_memory = trace_memory
+        self.profile_stage = profile_stage ### opt-in cProfile dump of this one stage
+        self.profile_path = profile_path
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name, exclude = None):
+        ### exclude: an object whose wall / cpu totals grow inside the stage (a renderer, see render_time()), that time is left out
+        started_tracing = False
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            started_tracing = True
+        elif self.trace_memory:
+            tracemalloc.reset_peak()
+        profile = cProfile.Profile() if name == self.profile_stage else None
+
+        excluded = (0.0, 0.0) if exclude is None else (exclude.wall, exclude.cpu)
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+                profile.dump_stats(self.profile_path)
+            record = {
+                "stage" : name,
+                "wall"  : time.perf_counter() - wall,
+                "cpu"   : time.process_time() - cpu,
+            }
+            if exclude is not None:
+                record["wall"] -= exclude.wall - excluded[0]
+                record["cpu"] -= exclude.cpu - excluded[1]
+            if self.trace_memory:
+                record["peak_memory"] = tracemalloc.get_traced_memory()[1]
+                if started_tracing:
+                    tracemalloc.stop()
+            self.stages.append(record)
+
+    def record(self, name, wall, cpu):
+        ### a stage timed elsewhere, e.g. the to_html time that stage(exclude = renderer) left out
+        self.stages.append({"stage" : name, "wall" : wall, "cpu" : cpu})
+
+    def dump(self, path):
+        report = {
+            "stages" : self.stages,
+            "wall"   : sum(record["wall"] for record in self.stages),
+            "cpu"    : sum(record["cpu"] for record in self.stages),
+        }
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+def discover_raw_data(root_path, start, end):
+    raw_path = os.path.join(root_path, "RawData")
+    found = []
+    for name in sorted(os.listdir(raw_path)):
+        if re.fullmatch(r"\d{8}", name) is None or not start <= name <= end:
+            continue
+        file_path = os.path.join(os.path.join(raw_path, name), "wind新股数据" + name + ".xlsx")
+        if os.path.exists(file_path):
+            found.append((name, file_path))
+    return found
+
+def load_day(date, file_path, cache_dir, history = None, pinyin_keys = None):
+    IPO_raw, subscription_raw, workday_sheet = load_workbook(file_path, cache_dir)
+    return run_context(datetime.strptime(date, "%Y%m%d"), IPO_raw, subscription_raw, workday_sheet, history, pinyin_keys)
+
+def backfill_history(date, file_path, cache_dir):
+    ### first pass: the history writes of one date, they do not depend on what earlier dates wrote
+    recorder = history_recorder()
+    IPO_calendar(load_day(date, file_path, cache_dir, recorder))
+    return recorder.ops
+
+def backfill_report(date, file_path, cache_dir, excel_save_path, history, pinyin_save_path):
+    ### second pass: the report of one date, built on the history as it stood after the previous date
+    context = load_day(date, file_path, cache_dir, history, pinyin_cache(pinyin_save_path))
+    data = IPO_calendar(context)
+    writer = excel_writer(excel_save_path, context, constant_memory = len(context.subscription_raw.index) > 100000)
+    writer.generate_IPO_calendar(data)
+    writer.today_offering(data)
+    writer.today_purchase(data)
+    writer.tomorrow_purchase(data)
+    writer.save()
+    return date
+
+def backfill(root_path, start, end, history, cache_dir = None, workers = None):
+    '''
+    Rebuild IPO_calendar/YYYYMMDD.xlsx for every RawData/YYYYMMDD between start and end.
+    The history writes of all dates are collected in parallel and merged in date order,
+    then every date is rendered in parallel with the history a sequential run would have seen.
+    Both passes load every workbook through cache_dir; without one (--no-cache) they share a temporary cache,
+    so each Excel file is still parsed once, and nothing is left behind.
+    '''
+    days = discover_raw_data(root_path, start, end)
+    start_time = time.perf_counter()
+
+    with tempfile.TemporaryDirectory(prefix = "IPO_backfill_") if cache_dir is None else nullcontext(cache_dir) as cache_dir, \
+         ProcessPoolExecutor(max_workers = workers) as pool:
+        ops = list(pool.map(backfill_history, [date for date, _ in days], [file_path for _, file_path in days], [cache_dir]*len(days)))
+
+        snapshots = []
+        for day_ops in ops:
+            snapshots.append(history.copy())
+            replay_history(history, day_ops)
+
+        futures = []
+        for (date, file_path), snapshot in zip(days, snapshots):
+            excel_save_path = os.path.join(os.path.join(root_path, "IPO_calendar"), date + ".xlsx")
+            futures.append(pool.submit(backfill_report, date, file_path, cache_dir, excel_save_path, snapshot, os.path.join(root_path, "pinyin.save")))
+        for future in futures:
+            print(future.result())
+
+    elapsed = time.perf_counter() - start_time
+    print(f"{len(days)} days in {elapsed:.1f}s, {len(days) / elapsed if elapsed > 0 else 0:.2f} days/s")
+    return [date for date, _ in days]
+
+
 if __name__ == '__main__':
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clear-cache", action = "store_true", help = "delete every cached parsed workbook and exit")
+    parser.add_argument("--no-cache", action = "store_true", help = "parse the Excel file even if a cached copy exists (--backfill keeps a temporary cache for its two passes)")
+    parser.add_argument("--backfill", nargs = 2, metavar = ("START", "END"), help = "rebuild the calendars of every RawData/YYYYMMDD in [START, END]")
+    parser.add_argument("--workers", type = int, default = None, help = "processes used by --backfill")
+    parser.add_argument("--trace-memory", action = "store_true", help = "add tracemalloc peaks to the run report, this slows every stage down several times")
+    parser.add_argument("--html", choices = list(html_renderers.keys()), default = "css", help = "HTML backend of the mail body")
+    parser.add_argument("--lookahead", type = int, default = None, metavar = "N", help = "calendar of the next N trading days instead of today and tomorrow")
+    parser.add_argument("--profile-stage", default = None, help = "dump a cProfile of this stage next to the workbook, e.g. \"build IPO_calendar\"")
+    args = parser.parse_args()
+
     # today = datetime(2021,7,16) ### for testing
     today = datetime.today()
 
     root_path = os.path.dirname(os.path.abspath(__file__))
     data_path = os.path.join(os.path.join(root_path, "RawData"), date_str(today))
+    cache_path = os.path.join(os.path.join(root_path, "RawData"), "cache")
+
+    if args.clear_cache:
+        clear_workbook_cache(cache_path)
+        sys.exit()
+
+    history_save_path = os.path.join(root_path, "history.save") ### legacy joblib dump, migrated into history.log on first run
+    history_log_path = os.path.join(root_path, "history.log")
+    pinyin_save_path = os.path.join(root_path, "pinyin.save")
+
+    if args.backfill is not None:
+        history = history_store(history_log_path, legacy_path = history_save_path)
+        backfill(root_path, args.backfill[0], args.backfill[1], history, None if args.no_cache else cache_path, args.workers)
+        history.close()
+        sys.exit()
 
     filename = "wind新股数据" + date_str(today) + ".xlsx"
     file_path = os.path.join(data_path, filename)
-
-    history_save_path = os.path.join(root_path, "history.save")
     excel_save_path = os.path.join(os.path.join(root_path, "IPO_calendar"), date_str(today)+".xlsx")
+    report_save_path = os.path.splitext(excel_save_path)[0] + ".json"
 
-    workday_sheet = pd.read_excel(file_path, sheet_name = 2)
+    profiler = run_profiler(args.trace_memory, args.profile_stage, os.path.splitext(excel_save_path)[0] + ".prof")
 
-    # tomorrow = today + timedelta(days = 1)
-    tomorrow = next_workday(today, workday_sheet)
+    with profiler.stage("load sheets"):
+        IPO_raw, subscription_raw, workday_sheet = load_workbook(file_path, None if args.no_cache else cache_path)
 
-    IPO_raw = pd.read_excel(file_path, sheet_name = 0)
-    subscription_raw = pd.read_excel(file_path, sheet_name = 1)
-    
 
     # history = {}
     # joblib.dump(history, history_save_path)
 
-    history = joblib.load(history_save_path)
-    # print(history)
-
-    data = IPO_calendar(IPO_raw, subscription_raw, workday_sheet, history)
-
-    joblib.dump(history, history_save_path)
-
-    writer = excel_writer(excel_save_path) 
-    html_tables = writer.generate_IPO_calendar(data)
-    html_tables += writer.today_offering(data)
-    html_tables += writer.today_purchase(data)
-    html_tables += writer.tomorrow_purchase(data)
-    writer.save()
+    history = history_store(history_log_path, legacy_path = history_save_path)
+    # print(history.entries)
+
+    pinyin_keys = pinyin_cache(pinyin_save_path)
+
+    # context = run_context(today, IPO_raw, subscription_raw, workday_sheet, history, pinyin_keys, tomorrow = today + timedelta(days = 1))
+    with profiler.stage("build IPO_calendar"):
+        context = run_context(today, IPO_raw, subscription_raw, workday_sheet, history, pinyin_keys)
+        data = IPO_calendar(context)
+
+    history.close()
+    pinyin_keys.save()
+
+    writer = excel_writer(excel_save_path, context, constant_memory = len(subscription_raw.index) > 100000, html = html_renderers[args.html]()) ### stream big allotment sheets
+    with profiler.stage("generate_IPO_calendar", exclude = writer.html):
+        html_tables = writer.generate_IPO_calendar(data, args.lookahead)
+    with profiler.stage("today_offering", exclude = writer.html):
+        html_tables += writer.today_offering(data)
+    with profiler.stage("today_purchase", exclude = writer.html):
+        html_tables += writer.today_purchase(data)
+    with profiler.stage("tomorrow_purchase", exclude = writer.html):
+        html_tables += writer.tomorrow_purchase(data)
+    with profiler.stage("save workbook"):
+        writer.save()
+    profiler.record("to_html", writer.html.wall, writer.html.cpu)
+    with profiler.stage("html document"):
+        mainbody = writer.html.document(html_tables)
     print(today)
     # print(history)
 
@@ -1383,14 +2148,15 @@ if __name__ == '__main__':
     # smtp_port=25
 
     # Email = mail(sender, authorization_code, smtp_server, smtp_port)
-    # mainbody = ""
-    # for html_table in html_tables:
-    #     mainbody += html_table
     # contents = MIMEText(mainbody, 'html', 'utf-8')
-    # Email.send(receiver, contents, attachment=excel_save_path, today=date_str(today))
-
-
-
-
+    # with profiler.stage("mail send"):
+    #     Email.send(receiver, contents, attachment=excel_save_path, today=date_str(today))
 
+    ### or queue it and let the spool worker deliver it (undelivered messages stay in spool/ for the next run)
+    # spool = mail_spool(os.path.join(root_path, "spool"), mail_pool(sender, authorization_code, smtp_server, smtp_port))
+    # spool.start()
+    # spool.put(receiver, mail_message(sender, receiver, contents, attachment=excel_save_path, today=date_str(today)))
+    # spool.stop(drain = True)
+    # print(spool.stats())
 
+    profiler.dump(report_save_path)
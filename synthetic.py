@@ -0,0 +1,149 @@
+import os
+import argparse
+
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from main import IPO_dict, subscription_dict, date_str
+
+
+
+### board prefix -> exchange suffix of the Wind code
+board_suffix = {
+    "60" : ".SH", ### mainboard
+    "00" : ".SZ", ### small and medium board
+    "68" : ".SH", ### S&T innovation board
+    "30" : ".SZ", ### second board
+}
+
+default_board_mix = {
+    "60" : 0.3,
+    "00" : 0.2,
+    "68" : 0.25,
+    "30" : 0.25,
+}
+
+name_chars = "华科电气新材料医药生物智能数控能源环保信息技术精密机械光学半导体汽车零部件食品饮料化工通信设备软件服务纺织建筑装饰物流"
+product_kinds = ["基金", "养老金产品", "企业年金计划", "资产管理计划", "保险产品", "证券投资基金"]
+
+### rows of one xlsx sheet, the header row included
+excel_row_limit = 1048576
+
+
+
+def trading_days(start, count):
+    days = []
+    date = start
+    while len(days) < count:
+        if date.weekday() < 5: ### no holiday calendar, weekdays only
+            days.append(int(date_str(date)))
+        date += timedelta(days = 1)
+    return days
+
+def random_names(rng, count, length):
+    chars = np.array(list(name_chars))
+    picks = rng.integers(0, len(chars), size = (count, length))
+    return ["".join(row) for row in chars[picks]]
+
+def generate_sheets(n_IPOs = 200, board_mix = None, online_ratio = 0.2, allotments_per_IPO = 500, n_products = None, start = datetime(2021, 1, 4), seed = 0, row_limit = excel_row_limit):
+    '''
+    Three DataFrames shaped like the Wind export: the IPO sheet (IPO_dict columns), the subscription sheet (subscription_dict columns)
+    and the workday sheet. Announcements are spread over the trading days so that every day has a few subscribing, paying and listing IPOs.
+    Raises ValueError when a sheet would not fit in row_limit rows with its header; pass row_limit = None for frames that never reach a workbook.
+    '''
+    rng = np.random.default_rng(seed)
+    board_mix = default_board_mix if board_mix is None else board_mix
+    n_products = allotments_per_IPO * 2 if n_products is None else n_products
+
+    ### roughly five announcements per trading day, plus room for the T+15 listing of the last one
+    n_days = max(n_IPOs // 5, 1) + 30
+    workdays = trading_days(start, n_days)
+
+    prefixes = rng.choice(list(board_mix.keys()), size = n_IPOs, p = np.array(list(board_mix.values())) / sum(board_mix.values()))
+    IDs = [f"{prefix}{i:04d}{board_suffix[prefix]}" for i, prefix in enumerate(prefixes)]
+    names = random_names(rng, n_IPOs, 4)
+    is_online = (rng.random(n_IPOs) < online_ratio) & np.isin(prefixes, ["60", "00"]) ### online-only issues are mainboard / SME
+    announced = rng.integers(0, n_days - 30, size = n_IPOs)
+    announced.sort()
+
+    def day(offset):
+        return [workdays[index + offset] for index in announced]
+
+    def offline_day(offset): ### empty for online-only issues
+        return pd.array([None if online else date for online, date in zip(is_online, day(offset))], dtype = "Int64")
+
+    prices = np.round(rng.uniform(5, 60, size = n_IPOs), 2)
+    issued_shares = rng.integers(2000, 20000, size = n_IPOs) * 1e4
+    funding = np.round(prices * issued_shares * rng.uniform(0.9, 1.1, size = n_IPOs), -4)
+    priced = np.isin(prefixes, ["68", "30"]) | (rng.random(n_IPOs) < 0.5) ### mainboard price is often estimated from funding
+
+    IPO_sheet = pd.DataFrame({
+        IPO_dict["ID"]                        : IDs,
+        IPO_dict["IPO_name"]                  : names,
+        IPO_dict["online"]                    : np.where(is_online, "网上发行", "网上网下发行"),
+        IPO_dict["announcement_date"]         : day(0),
+        IPO_dict["inquiry_date"]              : offline_day(3),
+        IPO_dict["offline_subscription_date"] : offline_day(5),
+        IPO_dict["offline_payment_date"]      : offline_day(7),
+        IPO_dict["offering_date"]             : day(15),
+        IPO_dict["purchase_limit"]            : rng.integers(100, 1000, size = n_IPOs) * 10.0,
+        IPO_dict["offline_purchase_limit"]    : np.where(is_online, np.nan, rng.integers(100, 1000, size = n_IPOs) * 1e4),
+        IPO_dict["funding"]                   : funding,
+        IPO_dict["issued_share"]              : issued_shares,
+        IPO_dict["price"]                     : np.where(priced, prices, np.nan),
+        IPO_dict["online_purchase_limit"]     : rng.integers(5, 50, size = n_IPOs) * 1000.0,
+        IPO_dict["online_subscription_date"]  : day(5),
+        IPO_dict["online_payment_date"]       : day(7),
+    })
+
+    ### allotment subjects of the offline issues, drawn from one pool of fund products
+    offline_IDs = np.array(IDs)[~is_online]
+    products = [name + product_kinds[i % len(product_kinds)] for i, name in enumerate(random_names(rng, n_products, 6))]
+    n_rows = len(offline_IDs) * allotments_per_IPO
+    if row_limit is not None and max(n_rows, n_IPOs) + 1 > row_limit:
+        raise ValueError(f"{max(n_rows, n_IPOs)} rows do not fit in one sheet of {row_limit} rows with its header, lower n_IPOs or allotments_per_IPO")
+    quotes = np.repeat(prices[~is_online], allotments_per_IPO) * rng.uniform(0.9, 1.1, size = n_rows)
+    subscription_amounts = rng.integers(10, 1000, size = n_rows) * 10.0
+    is_valid = rng.random(n_rows) < 0.85
+    subscription_sheet = pd.DataFrame({
+        subscription_dict["ID"]                        : np.repeat(offline_IDs, allotments_per_IPO),
+        subscription_dict["allotment_subject_name"]    : np.array(products)[rng.integers(0, n_products, size = n_rows)],
+        subscription_dict["valid_subscription_amount"] : np.where(is_valid, subscription_amounts, 0.0),
+        subscription_dict["allotment_amount"]          : np.where(is_valid, np.round(subscription_amounts * rng.uniform(0.5, 2.0, size = n_rows)), 0.0),
+        subscription_dict["lockup_period"]             : np.where(rng.random(n_rows) < 0.1, 6, 0),
+        subscription_dict["quote"]                     : np.round(quotes, 2),
+        subscription_dict["valid"]                     : np.where(is_valid, "有效", "无效"),
+        subscription_dict["subscription_amount"]       : subscription_amounts,
+    })
+
+    workday_sheet = pd.DataFrame({"交易日" : workdays})
+    return IPO_sheet, subscription_sheet, workday_sheet
+
+def generate_workbook(path, **kwargs):
+    return write_workbook(path, *generate_sheets(**kwargs))
+
+def write_workbook(path, IPO_sheet, subscription_sheet, workday_sheet):
+    with pd.ExcelWriter(path, engine = "xlsxwriter") as writer:
+        IPO_sheet.to_excel(writer, sheet_name = "新股", index = False)
+        subscription_sheet.to_excel(writer, sheet_name = "配售对象", index = False)
+        workday_sheet.to_excel(writer, sheet_name = "交易日", index = False)
+    return workday_sheet.iloc[:, 0].tolist()
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = "write a synthetic three-sheet Wind IPO workbook")
+    parser.add_argument("path")
+    parser.add_argument("--ipos", type = int, default = 200)
+    parser.add_argument("--allotments", type = int, default = 500, help = "allotment rows per offline IPO")
+    parser.add_argument("--online-ratio", type = float, default = 0.2)
+    parser.add_argument("--boards", default = "60:0.3,00:0.2,68:0.25,30:0.25", help = "board mix, prefix:weight pairs")
+    parser.add_argument("--seed", type = int, default = 0)
+    args = parser.parse_args()
+
+    board_mix = {prefix: float(weight) for prefix, weight in (pair.split(":") for pair in args.boards.split(","))}
+    os.makedirs(os.path.dirname(os.path.abspath(args.path)), exist_ok = True)
+    generate_workbook(args.path, n_IPOs = args.ipos, board_mix = board_mix, online_ratio = args.online_ratio, allotments_per_IPO = args.allotments, seed = args.seed)
@@ -0,0 +1,166 @@
+import os
+
+from datetime import datetime
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import main
+from synthetic import generate_sheets, random_names, write_workbook
+from benchmark import smtp_handler, smtp_stand_in, sample_messages, flaky_spool, pinyin_sort
+
+
+
+def snapshot(data):
+    ### what the report reads from an IPO_calendar: the buckets, every IPO's derived fields and the history it wrote
+    return {
+        "today"     : {key: [ipo.ID for ipo in IPOs] for key, IPOs in data.today_IPO.items()},
+        "tomorrow"  : {key: [ipo.ID for ipo in IPOs] for key, IPOs in data.tomorrow_IPO.items()},
+        "IPOs"      : [(ipo.ID, ipo.IPO_name, ipo.entry, ipo.lottery_date, ipo.allotment_subjects.names.tolist()) for ipo in data.IPOs],
+        "history"   : dict(data.context.history),
+    }
+
+def test_build_calendars_matches_sequential():
+    IPO_sheet, subscription_sheet, workday_sheet = generate_sheets(n_IPOs = 300, allotments_per_IPO = 30)
+    workdays = workday_sheet.iloc[:, 0].tolist()
+    days = [datetime.strptime(str(day), "%Y%m%d") for day in workdays[10:22]]
+    pinyin_keys = main.pinyin_cache()
+
+    def contexts():
+        return [main.run_context(day, IPO_sheet, subscription_sheet, workday_sheet, {}, pinyin_keys) for day in days]
+
+    sequential = [snapshot(main.IPO_calendar(context)) for context in contexts()]
+    concurrent = [snapshot(data) for data in main.build_calendars(contexts(), workers = 6)]
+
+    assert concurrent == sequential
+    assert any(len(IPOs) > 0 for result in sequential for IPOs in result["today"].values())
+
+def test_mail_pool_delivers_batch():
+    pytest.importorskip("aiosmtpd")
+    handler = smtp_handler()
+    with smtp_stand_in(handler) as (host, port):
+        pool = main.mail_pool("report@example.com", None, host, port, size = 4)
+        results = pool.send_batch(sample_messages(50))
+        pool.close()
+    assert results == [True] * 50
+    assert handler.received == 50
+
+def test_mail_spool_retries_refused_messages(tmp_path):
+    pytest.importorskip("aiosmtpd")
+    stats = flaky_spool(n_messages = 30, failure_rate = 0.5, workdir = str(tmp_path))
+    assert stats["queue_depth"] == 0
+    assert stats["delivered"] == stats["received"] == 30
+    assert stats["failed_attempts"] == stats["refused"] > 0
+    assert stats["given_up"] == 0
+
+def test_date_column_reads_datetime_cells(capsys):
+    IDs = pd.Series(["A", "B", "C", "D", "E"])
+    mixed = pd.Series([20210716, 20210716.0, datetime(2021, 7, 16), pd.NaT, "待定"], dtype = object, name = "上市日期")
+    assert main.date_column(mixed, IDs).tolist() == [20210716, 20210716, 20210716, pd.NA, pd.NA]
+    assert "上市日期 of E" in capsys.readouterr().out
+
+    parsed = pd.Series(pd.to_datetime(["2021-07-16", None, "2021-07-19", None, None]), name = "上市日期")
+    assert main.date_column(parsed, IDs).tolist() == [20210716, pd.NA, 20210719, pd.NA, pd.NA]
+    assert capsys.readouterr().out == ""
+
+def test_lookahead_details_cover_every_day(tmp_path):
+    IPO_sheet, subscription_sheet, workday_sheet = generate_sheets(n_IPOs = 200, allotments_per_IPO = 20)
+    today = datetime.strptime(str(workday_sheet.iloc[20, 0]), "%Y%m%d")
+    context = main.run_context(today, IPO_sheet, subscription_sheet, workday_sheet, {}, main.pinyin_cache())
+    data = main.IPO_calendar(context)
+    writer = main.excel_writer(str(tmp_path / "lookahead.xlsx"), context, html = main.css_renderer())
+    body = "".join(writer.generate_IPO_calendar(data, 5))
+    writer.save()
+
+    ahead = list(data.active_IPOs([bucket for _, bucket in data.lookahead(5)]))
+    assert len(ahead) > len(list(data.active_IPOs()))
+    details = body[body.index("详细信息"):]
+    assert all(ipo.IPO_name in details for ipo in ahead)
+
+def test_pinyin_cache_evicts_least_recently_used():
+    cache = main.pinyin_cache(capacity = 3)
+    for name in ["华科", "电气", "新材"]:
+        cache.key(name)
+    cache.key("华科") ### 电气 is now the least recently used
+    cache.key("医药")
+    assert list(cache.keys) == ["新材", "华科", "医药"]
+    assert cache.keys["医药"] == main.pinyin("医药")
+
+def test_pinyin_cache_save_load(tmp_path):
+    path = str(tmp_path / "pinyin.save")
+    names = random_names(np.random.default_rng(1), 200, 6)
+    cache = main.pinyin_cache(path)
+    order = cache.order(names)
+    cache.save()
+    assert not cache.updated
+    loaded = main.pinyin_cache(path)
+    assert loaded.keys == cache.keys
+    assert loaded.order(names) == order
+    assert not loaded.updated ### every key came from the file
+    assert [name for name in tmp_path.iterdir() if name.suffix == ".tmp"] == []
+
+def test_pinyin_cache_order_matches_pinyin_sort():
+    names = random_names(np.random.default_rng(2), 2000, 3)
+    names += names[:500] ### repeated allotment subjects
+    assert main.pinyin_cache(capacity = 100).order(names) == sorted(range(len(names)), key = lambda i: main.pinyin(names[i]))
+
+def test_pinyin_cache_warm_sort_is_faster(tmp_path):
+    timings = pinyin_sort(50000, str(tmp_path))
+    assert timings["warm"] < timings["cold"]
+    assert timings["reloaded"] < timings["cold"]
+
+def test_active_IPOs_dedup_at_10k():
+    class listed: ### identity equality, like IPO
+        __slots__ = ("ID", "online")
+        def __init__(self, ID, online):
+            self.ID = ID
+            self.online = online
+
+    rng = np.random.default_rng(3)
+    IPOs = [listed(f"{i:06d}.SH", i % 5 == 0) for i in range(10000)]
+    keys = list(main.calendar_dict.keys())
+    buckets = [{key: [] for key in keys}, {key: [] for key in keys}]
+    for i in rng.permutation(len(IPOs)).tolist() * 4: ### every issue in four events of the window
+        buckets[int(rng.integers(2))][keys[int(rng.integers(len(keys)))]].append(IPOs[i])
+    data = SimpleNamespace(today_IPO = buckets[0], tomorrow_IPO = buckets[1])
+
+    active = list(main.IPO_calendar.active_IPOs(data))
+    seen = [ipo for bucket in buckets for key in bucket.keys() for ipo in bucket[key]]
+    assert active == list(dict.fromkeys(seen)) ### first-seen order
+    assert len({ipo.ID for ipo in active}) == len(active) == len(IPOs)
+
+    offline = [] ### the list scan generate_IPO_calendar used before unique_IPOs
+    online = []
+    for bucket in buckets:
+        for key in bucket.keys():
+            for ipo in bucket[key]:
+                if not ipo.online and ipo not in offline:
+                    offline.append(ipo)
+                elif ipo.online and ipo not in online:
+                    online.append(ipo)
+    assert [ipo for ipo in active if not ipo.online] == offline
+    assert [ipo for ipo in active if ipo.online] == online
+
+def test_backfill_matches_sequential(tmp_path):
+    IPO_sheet, subscription_sheet, workday_sheet = generate_sheets(n_IPOs = 200, allotments_per_IPO = 30)
+    dates = [str(day) for day in workday_sheet.iloc[10:16, 0]]
+    names = main.IPO_dict["IPO_name"]
+    for i, date in enumerate(dates):
+        ### a later export may rename an issue, the history keeps the name a sequential run saw first
+        daily = IPO_sheet.copy()
+        renamed = daily.index % len(dates) == i
+        daily.loc[renamed, names] = daily.loc[renamed, names] + date[-2:]
+        os.makedirs(tmp_path / "RawData" / date)
+        write_workbook(str(tmp_path / "RawData" / date / f"wind新股数据{date}.xlsx"), daily, subscription_sheet, workday_sheet)
+    os.makedirs(tmp_path / "IPO_calendar")
+
+    sequential = {}
+    for date, file_path in main.discover_raw_data(str(tmp_path), dates[0], dates[-1]):
+        main.IPO_calendar(main.load_day(date, file_path, None, sequential))
+
+    history = {}
+    assert main.backfill(str(tmp_path), dates[0], dates[-1], history, workers = 3) == dates
+    assert history == sequential and len(history) > 0
+    assert sorted(os.listdir(tmp_path / "IPO_calendar")) == [date + ".xlsx" for date in dates]